@@ -1,2 +1,2 @@
-from .aiotuya import TuyaManager, TuyaScanner, TuyaLight, TuyaOCSwitch, TuyaSwitch, TuyaDevice
+from .aiotuya import TuyaManager, TuyaScanner, TuyaLight, TuyaOCSwitch, TuyaSwitch, TuyaDevice, TuyaGroup
 from .provision import TuyaProvision, TuyaCloud
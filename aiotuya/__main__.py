@@ -23,6 +23,7 @@
 # IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
 import argparse
 import csv
+import json
 import logging
 import os
 import random
@@ -53,20 +54,24 @@ class Devices():
     """ A simple class with a register and  unregister methods
     """
     def __init__(self):
-        self.devices=[]
+        self.known={}
+        self.sorted=None #Sorted when needed
         self.boi=None #bulb of interest
 
+    @property
+    def devices(self):
+        if self.sorted is None:
+            self.sorted = sorted(self.known.values(), key=lambda x: x.devid)
+        return self.sorted
+
     def register(self,device):
-        self.devices.append(device)
-        self.devices.sort(key=lambda x: x.devid)
+        self.known[device.devid] = device
+        self.sorted = None
 
     def unregister(self,device):
-        idx=0
-        for x in list([ y.devid for y in self.devices]):
-            if x == device.devid:
-                del(self.devices[idx])
-                break
-            idx+=1
+        if self.known.get(device.devid) is device:
+            del(self.known[device.devid])
+            self.sorted = None
 
     def got_data(self, data):
         pass
@@ -79,7 +84,6 @@ def readin():
     global manager
 
     selection = sys.stdin.readline().strip("\n")
-    MyDevs.devices.sort(key=lambda x: x.devid)
     lov=[ x for x in selection.split(" ") if x != ""]
     if lov:
         if MyDevs.boi:
@@ -221,10 +225,28 @@ class DevManager(tuya.TuyaManager):
             for row in reader:
                 self.known_devices[row[0]] = row[1]
 
+    def persist_fingerprints(self):
+        global opts
+        with open(opts.database + ".fingerprints", 'w') as f:
+            json.dump(self.fingerprints, f)
+
+    def load_fingerprints(self):
+        global opts
+        try:
+            with open(opts.database + ".fingerprints") as f:
+                self.fingerprints.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
 
 MyDevs= Devices()
 loop = aio.get_event_loop()
 manager = DevManager(dev_parent=MyDevs)
+try:
+    with open(opts.database + ".snapshot") as f:
+        manager.warm_start(json.load(f))
+except (OSError, ValueError):
+    pass
 scanner = tuya.TuyaScanner(parent=manager)
 scanner.start(loop)
 
@@ -238,6 +260,8 @@ except:
 finally:
     print()
     scanner.close()
+    with open(opts.database + ".snapshot", "w") as f:
+        json.dump(manager.snapshot(), f)
     manager.close()
     loop.remove_reader(sys.stdin)
     loop.run_until_complete(aio.sleep(2))
@@ -47,9 +47,14 @@ import logging
 
 import asyncio as aio
 import base64
+import ipaddress
 import json
-from collections import OrderedDict
-from colorsys import hsv_to_rgb, rgb_to_hsv
+import random
+from binascii import crc32
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from functools import partial
+from colorsys import rgb_to_hsv
 from Crypto.Cipher import AES
 from hashlib import md5
 from time import time
@@ -58,149 +63,522 @@ MAXNORESP = 5
 DFLTPORT = 6668
 DFLTVERS = "3.1"
 DISCCNT = 3
+DFLTTIMEOUT = 5
+#Heartbeat scheduler: wheel resolution and size, jitter, growth and maximum of the
+#interval, and the part of the interval during which received data replaces a poll.
+HBTICK = 0.25
+HBSLOTS = 256
+HBJITTER = 0.1
+HBGROWTH = 1.25
+HBMAX = 20
+HBRECENT = 0.5
+#Minimum time between the first polls of devices started together, in secs
+HBPACE = 0.01
+#Connections being established at once by TuyaManager, and number of connect times kept
+MAXCONNECTS = 16
+ADMITSAMPLES = 100
+#Reconnection backoff, in secs
+RECONBASE = 1
+RECONMAX = 60
+#Time between light transition frames, in secs
+TRANSPERIOD = 0.2
+#Broadcasts already seen are ignored for SCANTTL secs, the SCANCACHE most recent are kept
+SCANTTL = 10
+SCANCACHE = 4096
+#Active discovery: how many hosts are probed at once, and how long each may take, in secs
+SWEEPCONC = 64
+SWEEPTIMEOUT = 0.5
+#Key of the encrypted broadcasts
+UDPKEY = md5(b"yGAdlopoPVldABfn").digest()
+#Accepted values for dps conversion
+ONVALUES = frozenset([True, 1, "on", "On", "ON", "oN"])
+OCSTATES = {"open": "1", "close": "2", "idle": "3"}
+LIGHTMODES = frozenset(['white','colour','scene','scene_1','scene_2','scene_3','scene_4'])
+#Colour conversion tables. Tuya colours are rrggbb00hhssvv, all in hex bytes
+class HexTable(dict):
+    """Hex pairs to bytes, pairs not in the table, e.g. mixed case, are converted"""
+    def __missing__(self, key):
+        return int(key, 16)
+
+HEXBYTE = ['%02x' % x for x in range(256)]
+BYTEHEX = HexTable(zip(HEXBYTE, range(256)))
+BYTEHEX.update(zip([x.upper() for x in HEXBYTE], range(256)))
+HUEBYTE = [HEXBYTE[round(x*255/360)] for x in range(361)]
+PCTBYTE = [HEXBYTE[round(x*255/100)] for x in range(101)]
+BYTEHUE = [round(x*360/255) for x in range(256)]
+BYTEPCT = [round(x*100/255) for x in range(256)]
+#For each hue, the colorsys sector and fraction
+HUESECTOR = [(int(x/360*6.0) % 6, x/360*6.0 - int(x/360*6.0)) for x in range(361)]
+COLOURCACHESIZE = 0x10000
+PREFIX = b'\x00\x00\x55\xaa'
+SUFFIX = b'\x00\x00\xaa\x55'
+HDRSIZE = 16   #Prefix, sequence number, command and size
+TRLSIZE = 8    #CRC and suffix
+MAXMSGSIZE = 0xffff
+V33PADSIZE = 12
+V33PAD = b'\x00'*V33PADSIZE   #What follows the version in 3.3 headers
+PKCS7PADS = [bytes((x,))*x for x in range(17)]
+#Frame templates: prefix, sequence number (set when encoding) and command byte
+FRAMEHEADER = {"get": PREFIX + b'\x00'*7 + b'\x0a',
+               "set": PREFIX + b'\x00'*7 + b'\x07'}
+#Command byte of the status frames devices push on their own, e.g. after a change
+STATUSCMD = 0x08
+#CRC (computed for each frame) and suffix
+FRAMETRAILER = b'\x00'*4 + SUFFIX
 
 log = logging.getLogger(__name__)
 
+#JSON serialization. Both functions work with bytes, not str, and json_loads
+#accepts memoryview. orjson is used when available.
+try:
+    import orjson
+
+    JSONBACKEND = "orjson"
+
+    def json_dumps(data):
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+    json_loads = orjson.loads
+
+except ImportError:
+    JSONBACKEND = "json"
+
+    def json_dumps(data):
+        return json.dumps(data,separators=(',', ':')).encode()
+
+    def json_loads(data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return json.loads(data)
+
 class TuyaException(Exception):
     pass
 
+class TuyaDecryptError(TuyaException):
+    pass
+
 class TuyaCipher():
 
+    __slots__ = ("key", "version", "binary", "cipher", "md5suffix")
+
+    #Process-wide cache, see TuyaCipher.get
+    cache = {}
+    #Hash state after the constant start of the signed string
+    md5prefix = md5(b"data=")
+
     def __init__(self, key, version="3.1"):
         self.key = key
         try:
             self.version = version.encode()
         except:
-            print("This is it {}".format(version))
             self.version = version
+        #From 3.2 on, payloads are raw binary instead of base64 and are not signed
+        self.binary = self.version not in (b"", b"3.1")
         self.cipher = AES.new(self.key, AES.MODE_ECB)
+        #Constant end of the signed string
+        self.md5suffix = b"||lpv="+self.version+b"||"+(self.key.encode() if isinstance(self.key, str) else self.key)
+
+    @classmethod
+    def get(cls, key, version="3.1"):
+        """Return the shared cipher for this key and version, creating it if needed.
+
+        Ciphers hold no per-message state, so devices using the same key can share one.
+        """
+        try:
+            return cls.cache[(key, version)]
+        except KeyError:
+            cipher = cls.cache[(key, version)] = cls(key, version)
+            return cipher
 
     def decrypt(self, rawdata):
-        if self.version:
-            data = base64.b64decode(rawdata[19:])
-        else:
-            data = rawdata
+        """Decrypt a payload and decode its JSON content.
+
+        The PKCS7 padding is checked and stripped from the end of the plaintext, the JSON is
+        decoded straight from a memoryview of it.
 
-        data = self.cipher.decrypt(data)
+        :param rawdata: The encrypted payload
+        :type rawdata: bytes/memoryview
+        :returns: the decoded data
+        :rtype: dict
+        :raises TuyaDecryptError: when the payload cannot be decrypted, e.g. wrong key
+        """
         try:
-            return json.loads(data[:data.rfind(b'}')+1])
-        except:
-            return data
+            if self.binary:
+                #3.3: raw binary, status frames start with the version header
+                if rawdata[:len(self.version)] == self.version:
+                    data = rawdata[len(self.version)+V33PADSIZE:]
+                else:
+                    data = rawdata
+            elif self.version:
+                data = base64.b64decode(rawdata[19:])
+            else:
+                data = rawdata
 
-    def encrypt(self, rawdata):
-        data=json.dumps(rawdata,separators=(',', ':')).encode()
-        if len(data)%16 :
-            pbyte = int.to_bytes(16 - len(data)%16, 1, "big")
-            data += pbyte * (16 - len(data)%16)
+            data = self.cipher.decrypt(data)
+        except ValueError:
+            #Raised outside of the handler so the error does not hold on to rawdata
+            data = b''
+
+        pbyte = data[-1] if data else 0
+        if pbyte < 1 or pbyte > 16 or data[-pbyte:] != PKCS7PADS[pbyte]:
+            raise TuyaDecryptError("Incorrect length or padding, wrong key?")
+        try:
+            return json_loads(memoryview(data)[:-pbyte])
+        except ValueError:
+            pass
+        raise TuyaDecryptError("Incorrect payload, wrong key?")
 
-        data = self.cipher.encrypt(data)
+    def encrypt(self, rawdata):
+        """Encrypt rawdata and return the encrypted data with the bytes that follow the
+        version in the header: the MD5 signature for 3.1, padding for 3.3
+        """
+        data = self.cipher.encrypt(self.pad(json_dumps(rawdata)))
+        if self.binary:
+            return data, V33PAD
         if self.version:
             data = base64.b64encode(data)
         return data, self.md5(data)
 
+    def payload(self, command, rawdata):
+        """Return the payload of a frame for this protocol version, as a tuple of bytes chunks
+
+        :param command: The command, "get" or "set"
+        :type command: str
+        :param rawdata: The data to send
+        :type rawdata: dict
+        :returns: the payload chunks, see TuyaMessage.encode
+        :rtype: tuple
+        """
+        if command == "get":
+            if self.binary:
+                #No version header on queries
+                return (self.cipher.encrypt(self.pad(json_dumps(rawdata))),)
+            return (json_dumps(rawdata),)
+        data, sign = self.encrypt(rawdata)
+        return (self.version, sign, data)
+
+    @staticmethod
+    def pad(data):
+        """PKCS7 padding"""
+        return data + PKCS7PADS[16 - len(data)%16]
+
     def md5(self,data):
-        thisdata = b"data="+data+b"||lpv="+self.version+b"||"+self.key.encode()
-        return md5(thisdata).hexdigest().lower()[8:24].encode()
+        thismd5 = self.md5prefix.copy()
+        thismd5.update(data)
+        thismd5.update(self.md5suffix)
+        return thismd5.hexdigest()[8:24].encode()
 
 
 class TuyaMessage():
 
+    __slots__ = ("cipher", "buffer", "seqno")
+
     def __init__(self, cipher = None):
         self.cipher = cipher
-        self.leftover = ""
+        self.buffer = bytearray()
+        self.seqno = 0
 
     def parse(self, data):
+        """Parse a self-contained message, e.g. a UDP datagram.
+
+        :param data: The received bytes
+        :type data: bytes
+        :returns: a list of (return code, payload, sequence number) tuples
+        :rtype: list
+        """
         if data is None:
             raise TuyaException("No data to parse")
-        if len(data) < 16:
+        if len(data) < HDRSIZE:
             raise TuyaException("Message too short to be parsed")
 
-        processmsg = True
+        result, consumed = self._decode(data)
+        if consumed < len(data):
+            result.append((999, TuyaException("Incomplete message"), 0))
+        return result
+
+    def feed(self, data, withcmd=False):
+        """Add data received from a stream connection to the receive buffer and parse
+        all the complete frames it contains. A partial frame is kept in the buffer until
+        the rest of it is received.
+
+        :param data: The received bytes
+        :type data: bytes
+        :param withcmd: Add the command byte of the frame, None for errors, to each tuple
+        :type withcmd: bool
+        :returns: a list of (return code, payload, sequence number) tuples
+        :rtype: list
+        """
+        self.buffer += data
+        result, consumed = self._decode(self.buffer, withcmd)
+        if consumed:
+            del self.buffer[:consumed]
+        return result
+
+    def reset(self):
+        """Discard whatever is left in the receive buffer, e.g. on a new connection"""
+        self.buffer.clear()
+
+    def _decode(self, data, withcmd=False):
+        """Find the frames in data. Frame boundaries are tracked as offsets and the payloads
+        are handed over as memoryview slices, so nothing is copied until decrypting/decoding.
+
+        Returns the list of results and the number of bytes consumed.
+        """
         result = []
+        nocmd = (None,) if withcmd else ()
+        offset = 0
+        size = len(data)
+        with memoryview(data) as view:
+            while size - offset >= HDRSIZE:
+                if not data.startswith(PREFIX, offset):
+                    result.append((999, TuyaException("Incorrect prefix"), 0) + nocmd)
+                    offset, found = self._resync(data, offset, size)
+                    if not found:
+                        break
+                    continue
 
-        while processmsg:
-            prefix = data[:4]
+                msgsize = int.from_bytes(view[offset+12:offset+16], "big")
+                if msgsize < TRLSIZE or msgsize > MAXMSGSIZE:
+                    result.append((999, TuyaException("Incorrect message size"), 0) + nocmd)
+                    offset, found = self._resync(data, offset, size)
+                    if not found:
+                        break
+                    continue
 
-            if prefix != b'\x00\x00\x55\xaa':
-                result.append((999,TuyaException("Incorrect prefix")))
-                break
+                end = offset + HDRSIZE + msgsize
+                if end > size:
+                    #Wait for the rest of the frame
+                    break
 
-            suffix = data[-4:]
+                if not data.startswith(SUFFIX, end - len(SUFFIX)):
+                    result.append((999, TuyaException("Incorrect suffix"), 0) + nocmd)
+                    offset, found = self._resync(data, offset, size)
+                    if not found:
+                        break
+                    continue
 
-            if suffix != b'\x00\x00\xaa\x55':
-                result.append((999, TuyaException("Incorrect suffix")))
-                break
+                seqno = int.from_bytes(view[offset+4:offset+8], "big")
+                cmdbyte = data[offset+11]
+                entry = self._payload(data, view, cmdbyte, seqno, offset + HDRSIZE, end - TRLSIZE)
+                result.append(entry + (cmdbyte,) if withcmd else entry)
+                offset = end
 
-            cmdbyte = data[11:12]
-            msgsize = int.from_bytes(data[12:16],"big")
+        return result, offset
 
-            if msgsize != len(data[12:-4]):
-                self.leftover = data[16+msgsize:]
-                data = data[:16+msgsize]
-                log.debug("{} vs {}".format(msgsize,len(data[12:-4])))
-                log.debug("Leftover is {}".format(self.leftover))
-            else:
-                self.leftover = ''
-                processmsg = False
+    @staticmethod
+    def _resync(data, offset, size):
+        """Skip a bad frame so that it is reported only once.
 
+        :returns: the offset of the next prefix and True, or, when there is none, the
+            offset where to stop, keeping what could be the beginning of a prefix, and False
+        """
+        nextoff = data.find(PREFIX, offset + 1)
+        if nextoff < 0:
+            return max(offset + 1, size - len(PREFIX) + 1), False
+        return nextoff, True
+
+    def _payload(self, data, view, cmdbyte, seqno, start, end):
+        """Decode the payload of a frame, located between start and end"""
+        returncode = 0
+        if end - start >= 4:
+            returncode = int.from_bytes(view[start:start+4], "big")
+            if returncode & 0xffffff00:
+                #Not a return code, the payload starts right away
+                returncode = 0
+            else:
+                start += 4
+        log.debug("Return Code is {}".format(returncode))
+        if returncode:
+            log.debug("Error: {}".format(view[start:end].tobytes()))
+
+        #Skipping 0x00 padding, but binary payloads can start with 0x00
+        if self.cipher and self.cipher.binary:
+            if not any(view[start:end]):
+                start = end
+        else:
+            while start < end and not data[start]:
+                start += 1
+        if start == end:
+            #Empty message
+            return (returncode, None, seqno)
 
-            #Removing Prefix, Msg size, also crc and suffix
-            mydata = data[16:-8]
-            returncode = int.from_bytes(mydata[:4],"big")
-            log.debug("Return Code is {}".format(returncode))
-            if returncode:
-                log.debug("Error: {}".format(data))
-            #Removing 0x00 padding
+        if self.cipher and (cmdbyte != 0x0a or self.cipher.binary):
             try:
-                while mydata[0:1] == b'\x00':
-                    mydata = mydata[1:]
-            except:
-                #Empty message
-                result.append((returncode, None))
-                if self.leftover:
-                    continue
-                else:
-                    break
+                return (returncode, self.cipher.decrypt(view[start:end]), seqno)
+            except TuyaDecryptError as e:
+                #The traceback references the receive buffer
+                return (returncode or 999, e.with_traceback(None), seqno)
 
-            if self.cipher and cmdbyte != b'\x0a':
-                result.append((returncode, self.cipher.decrypt(mydata)))
-            else:
-                #log.debug("Loading {}".format(mydata[:mydata.decode().rfind('}')+1]))
-                try:
-                    result.append((returncode, json.loads(mydata.decode()[:mydata.decode().rfind('}')+1])))
-                except:
-                    result.append((returncode, mydata))
-        return result
+        stop = data.rfind(b'}', start, end) + 1
+        try:
+            return (returncode, json_loads(view[start:stop]), seqno)
+        except ValueError:
+            return (returncode or 999, view[start:end].tobytes(), seqno)
 
-    def encode(self, command, data):
-        if command == "get":
-            cmdbyte = b'\x0a'
-        elif command == 'set':
-            cmdbyte = b'\x07'
-        else:
-            raise TuyaException("Unknown command")
+    def next_seqno(self):
+        """Return a new sequence number for an outgoing frame. 0 is never returned, it is
+        kept for frames we do not expect to match with a response.
+        """
+        self.seqno = self.seqno % 0xffffffff + 1
+        return self.seqno
+
+    def encode(self, command, data, seqno=0):
+        """Encode a single frame.
+
+        :param command: The command, "get" or "set"
+        :type command: str
+        :param data: The payload. A dict is JSON encoded, a list/tuple is taken as a sequence of bytes chunks.
+        :type data: dict/str/bytes/list
+        :param seqno: The sequence number of the frame
+        :type seqno: int
+        :returns: the frame
+        :rtype: bytearray
+        """
+        return self.encode_many([(command, data, seqno)])
 
+    def renumber(self, frame, seqno):
+        """Return a copy of a single encoded frame with a new sequence number
+
+        :param frame: The frame, as returned by encode
+        :type frame: bytes
+        :param seqno: The sequence number of the frame
+        :type seqno: int
+        :returns: the frame
+        :rtype: bytearray
+        """
+        frame = bytearray(frame)
+        frame[4:8] = seqno.to_bytes(4, "big")
+        frame[-TRLSIZE:-4] = (crc32(memoryview(frame)[:-TRLSIZE]) & 0xffffffff).to_bytes(4, "big")
+        return frame
+
+    def encode_many(self, commands):
+        """Encode several frames into a single contiguous buffer. The buffer is allocated
+        once with its final size and the frames are built in place from the header templates.
+
+        :param commands: The frames to encode as (command, data) or (command, data, seqno) tuples, see encode.
+        :type commands: list
+        :returns: the frames
+        :rtype: bytearray
+        """
+        frames = []
+        total = 0
+        for command, data, *seqno in commands:
+            try:
+                header = FRAMEHEADER[command]
+            except KeyError:
+                raise TuyaException("Unknown command")
+            chunks = self._chunks(data)
+            size = sum(len(x) for x in chunks) + TRLSIZE
+            frames.append((header, seqno[0] if seqno else 0, chunks, size))
+            total += HDRSIZE + size
+
+        buf = bytearray(total)
+        pos = 0
+        for header, seqno, chunks, size in frames:
+            start = pos
+            buf[pos:pos+12] = header
+            if seqno:
+                buf[pos+4:pos+8] = seqno.to_bytes(4, "big")
+            buf[pos+12:pos+HDRSIZE] = size.to_bytes(4, "big")
+            pos += HDRSIZE
+            for chunk in chunks:
+                buf[pos:pos+len(chunk)] = chunk
+                pos += len(chunk)
+            buf[pos:pos+TRLSIZE] = FRAMETRAILER
+            #3.1 devices ignore it, 3.3 devices check it
+            buf[pos:pos+4] = (crc32(memoryview(buf)[start:pos]) & 0xffffffff).to_bytes(4, "big")
+            pos += TRLSIZE
+        return buf
+
+    def _chunks(self, data):
         if isinstance(data, dict):
-            payload = json.dumps(data,separators=(',', ':')).encode()
+            return (json_dumps(data),)
         elif isinstance(data, str):
-            payload = data.encode()
-        elif isinstance(data,bytes):
-            payload = data
-        else:
-            raise TuyaException("Don't know who to send {}".format(data.__class__))
+            return (data.encode(),)
+        elif isinstance(data, (bytes, bytearray)):
+            return (data,)
+        elif isinstance(data, (list, tuple)):
+            return data
+        raise TuyaException("Don't know how to send {}".format(data.__class__))
+
+
+MISSING = object()
+
+class TuyaStatus(MutableMapping):
+    """Compact device status, a mutable mapping that compares equal to the matching dict.
+    Use as_dict, e.g. for json.dumps, when an actual dict is needed.
+
+    The values of the dps in the device schema are kept in a list, at the position given by
+    the index shared by all the devices of a class. Anything else goes in a dict created
+    when needed.
 
-        prefix = b'\x00\x00\x55\xaa'+ b'\x00'*7 + cmdbyte
-        #CRC
-        payload += b'\x00'*4   #Apparently not checked, so we don't bother
-        #Suffix
-        payload += b'\x00\x00\xaa\x55'
+        :param index: The position of each known name
+        :type index: dict
+    """
+
+    __slots__ = ("index", "data", "extra")
+
+    def __init__(self, index):
+        self.index = index
+        self.data = [MISSING] * len(index)
+        self.extra = None
+
+    def __getitem__(self, key):
         try:
-            return prefix + int.to_bytes(len(payload),4,"big") + payload
-        except Exception as e:
-            log.debug("Error was {}".format(e))
-            return None
+            val = self.data[self.index[key]]
+        except KeyError:
+            if self.extra is None:
+                raise
+            return self.extra[key]
+        if val is MISSING:
+            raise KeyError(key)
+        return val
+
+    def __setitem__(self, key, val):
+        try:
+            self.data[self.index[key]] = val
+        except KeyError:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = val
+
+    def __delitem__(self, key):
+        try:
+            pos = self.index[key]
+        except KeyError:
+            if self.extra is None:
+                raise
+            del self.extra[key]
+            return
+        if self.data[pos] is MISSING:
+            raise KeyError(key)
+        self.data[pos] = MISSING
+
+    def __contains__(self, key):
+        try:
+            return self.data[self.index[key]] is not MISSING
+        except KeyError:
+            return self.extra is not None and key in self.extra
+
+    def __iter__(self):
+        for key, pos in self.index.items():
+            if self.data[pos] is not MISSING:
+                yield key
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for x in self.data if x is not MISSING) + (len(self.extra) if self.extra else 0)
+
+    def __repr__(self):
+        return repr(self.as_dict())
 
+    def as_dict(self):
+        """The status as a dict"""
+        return {x: self[x] for x in self}
 
+    def copy(self):
+        return self.as_dict()
 
 
 class TuyaDevice(aio.Protocol):
@@ -220,8 +598,39 @@ class TuyaDevice(aio.Protocol):
         :rtype: DatagramProtocol
     """
 
+    #Device classes declare their dps in dpsschema, a list of (dp id, name, encoder, decoder).
+    #The encoder converts a value to what the device expects, the decoder, called with the
+    #device and the value, converts what the device reports. Either can be None.
+    #The schema is compiled into dpsencode/dpsdecode when the class is created.
+    #dpsmap/dpsvalmap, names and encoders in dp order, are still accepted.
+    dpsschema = []
     dpsmap = []
     dpsvalmap = [ ]
+    dpsencode = {}
+    dpsdecode = {}
+    dpsindex = {"devId": 0}
+
+    __slots__ = ("devid", "ip", "port", "parent", "cipher", "message", "hb", "hbframe", "hbtask",
+                 "scheduler", "last_seen", "admission", "reconnect", "reconnect_attempt",
+                 "reconnect_handle", "closing", "transport", "loop", "task", "noresponse", "disconnect_count",
+                 "last_status", "raw_dps", "changes_only", "attemps", "waiting", "acked", "coalesce",
+                 "coalesced_dps", "coalesced_seqno", "flush_handle", "rate", "burst", "tokens",
+                 "tokens_time", "paused", "dropped", "optimistic", "pending", "pending_handles",
+                 "__weakref__")
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if "dpsschema" in cls.__dict__:
+            schema = cls.dpsschema
+        elif "dpsmap" in cls.__dict__:
+            schema = [(idx + 1, name, encoder, None) for idx, (name, encoder) in enumerate(zip(cls.dpsmap, cls.dpsvalmap))]
+        else:
+            #Inherited
+            return
+        cls.dpsencode = {name: (str(dpid), encoder) for dpid, name, encoder, decoder in schema}
+        cls.dpsdecode = {str(dpid): (name, decoder) for dpid, name, encoder, decoder in schema}
+        cls.dpsindex = {"devId": 0}
+        cls.dpsindex.update((name, idx + 1) for idx, (dpid, name, encoder, decoder) in enumerate(schema))
 
     def __init__(self,devid, key, ip_addr, port=DFLTPORT, parent=[], vers=DFLTVERS, heartbeat=10):
         self.devid = devid
@@ -231,35 +640,131 @@ class TuyaDevice(aio.Protocol):
             self.parent = [parent]
         else:
             self.parent = parent
-        self.cipher = TuyaCipher(key, vers)
+        self.cipher = TuyaCipher.get(key, vers)
         self.message = TuyaMessage(cipher=self.cipher)
         self.hb = heartbeat
+        self.hbframe = None
         self.hbtask = None
+        #When set, a TuyaHeartbeat drives the heartbeat instead of our own task
+        self.scheduler = None
+        self.last_seen = 0
+        #When set, a TuyaAdmission decides when we connect
+        self.admission = None
+        #Reconnection, with exponential backoff, when the connection is lost
+        self.reconnect = False
+        self.reconnect_attempt = 0
+        self.reconnect_handle = None
+        self.closing = False
         self.transport = None
         self.loop = None
         self.task = None
         self.noresponse = 0
         self.disconnect_count = DISCCNT
-        self.last_status = {}
+        self.last_status = TuyaStatus(self.dpsindex)
         self.raw_dps = False
+        #Only report the values that changed
+        self.changes_only = False
+        self.attemps = 0
+        #The containers below are only created when needed, they stay None otherwise.
+        #Commands waiting for a response, by sequence number: list of (future, dps or None).
+        #Coalesced commands share a sequence number.
+        self.waiting = None
+        #Acknowledged set commands, waiting for the status
+        self.acked = None
+        #Coalescing of set commands. None: off, 0: within the same loop iteration,
+        #otherwise the window in secs
+        self.coalesce = None
+        self.coalesced_dps = None
+        self.coalesced_seqno = 0
+        self.flush_handle = None
+        #Rate limiting, a token bucket allowing rate commands per sec, with bursts
+        #of up to burst commands. None: no limit
+        self.rate = None
+        self.burst = 1
+        self.tokens = 0
+        self.tokens_time = 0
+        self.paused = False
+        #Number of queued values replaced before being sent
+        self.dropped = 0
+        #Optimistic updates. None: off, otherwise how long, in secs, the device has to confirm
+        #the values set before they are rolled back
+        self.optimistic = None
+        #Values set but not yet confirmed, by name: [value set, value last reported, seqno, acked]
+        self.pending = None
+        self.pending_handles = None
 
 
     def start(self, loop):
         """Starting the control of the device
         """
         self.loop = loop
+        self.closing = False
         coro = self.loop.create_connection(
             lambda: self, self.ip, self.port)
 
         self.task = self.loop.create_task(coro)
+        self.task.add_done_callback(self._connect_done)
         return self.task
 
+    def _connect_done(self, task):
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc:
+            log.debug("Could not connect to {}: {}".format(self.devid, exc))
+            if self.reconnect:
+                self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        if self.reconnect_handle or self.closing:
+            return
+        delay = min(RECONMAX, RECONBASE * 2 ** self.reconnect_attempt) * random.uniform(0.5, 1)
+        self.reconnect_attempt += 1
+        log.debug("Reconnecting {} in {:.1f} secs".format(self.devid, delay))
+        for aparent in self.parent:
+            #Optional parent method
+            cb = getattr(aparent, "reconnecting", None)
+            if cb:
+                cb(self, self.reconnect_attempt, delay)
+        self.reconnect_handle = self.loop.call_later(delay, self._reconnect)
+
+    def _reconnect(self):
+        self.reconnect_handle = None
+        if self.closing or self.transport:
+            return
+        self._restart()
+
+    def _restart(self):
+        if self.admission:
+            self.admission.admit(self)
+        else:
+            self.start(self.loop)
+
+    def redial(self):
+        """Reconnect now, e.g. after the device IP address changed"""
+        self.reconnect_attempt = 0
+        if self.reconnect_handle:
+            self.reconnect_handle.cancel()
+            self.reconnect_handle = None
+        if self.transport:
+            #connection_lost will take care of it
+            self.hangup()
+        elif self.loop:
+            if self.task and not self.task.done():
+                self.task.cancel()
+            self._restart()
+
     def connection_made(self, transport):
         self.transport = transport
+        self.reconnect_attempt = 0
+        self.message.reset()
         #Start heartbeat
         #log.debug("Starting HB")
         #self.initial_command()
-        self.hbtask = self.loop.create_task(self.heartbeat())
+        if self.scheduler:
+            self.scheduler.add(self)
+        else:
+            self.hbtask = self.loop.create_task(self.heartbeat())
         for aparent in self.parent:
             aparent.register(self)
 
@@ -270,40 +775,152 @@ class TuyaDevice(aio.Protocol):
     def data_received(self, data):
         #log.debug("Got data")
         self.disconnect_count = DISCCNT
-        dev_data = {} #For the except.. just in case
-        try:
-            for rcode, rcvdata in self.message.parse(data):
-                log.debug("Processing received data {}, {}".format(rcode,rcvdata))
-                if not rcvdata:
-                    continue
-                if rcode:
-                    for aparent in self.parent:
-                        aparent.got_error(self,dev_data)
-                    continue
-                #log.debug('Raw Data received: {!r}'.format(rcvdata))
-                dev_data={}
-                if "devId" in rcvdata:
-                    dev_data["devId"] = rcvdata["devId"]
-                if "dps" in rcvdata:
-                    for x in rcvdata["dps"]:
+        self.last_seen = self.loop.time()
+        #A non-zero code comes with an error, otherwise we get a dict or None
+        for rcode, rcvdata, seqno, cmdbyte in self.message.feed(data, True):
+            log.debug("Processing received data {}, {}, {}".format(rcode,rcvdata,seqno))
+            waiters = self.waiting.pop(seqno, None) if seqno and self.waiting else None
+            if not rcvdata:
+                if waiters:
+                    #Acknowledged, the dps will come with the status
+                    if self.acked is None:
+                        self.acked = {}
+                    self.acked.setdefault(seqno, []).extend(waiters)
+                if seqno and self.pending:
+                    for entry in self.pending.values():
+                        if entry[2] == seqno:
+                            entry[3] = True
+                continue
+            if rcode:
+                for fut, dps in waiters or ():
+                    if not fut.done():
+                        fut.set_exception(TuyaException("Error {}: {}".format(rcode, rcvdata)))
+                for aparent in self.parent:
+                    aparent.got_error(self, rcvdata)
+                continue
+            #log.debug('Raw Data received: {!r}'.format(rcvdata))
+            if not isinstance(rcvdata, dict):
+                log.debug("Unexpected data from {}: {!r}".format(self.devid, rcvdata))
+                continue
+            dev_data={}
+            if "devId" in rcvdata:
+                dev_data["devId"] = rcvdata["devId"]
+            if isinstance(rcvdata.get("dps"), dict):
+                dpsdecode = self.dpsdecode
+                for x, val in rcvdata["dps"].items():
+                    try:
+                        name, decoder = dpsdecode[x]
+                    except KeyError:
+                        if self.raw_dps:
+                            dev_data[x] = val
+                        continue
+                    if decoder:
                         try:
-                            dev_data[self.dpsmap[int(x)-1]] = rcvdata["dps"][x]
-                        except:
-                            if self.raw_dps:
-                                dev_data[x] = rcvdata["dps"][x]
-                dev_data = self.normalize_data(dev_data)
-                for x in dev_data:
-                    self.last_status[x] = dev_data[x]
+                            val = decoder(self, val)
+                        except (KeyError, ValueError, TypeError, IndexError) as e:
+                            log.debug("Could not decode dp {} of {}, {!r}: {!r}".format(x, self.devid, val, e))
+                            continue
+                    dev_data[name] = val
+            dev_data = self.normalize_data(dev_data)
+            if self.pending:
+                self.reconcile(dev_data)
+            if self.changes_only:
+                self.deliver_changes(dev_data)
+            else:
+                self.last_status.update(dev_data)
                 for aparent in self.parent:
                     aparent.got_data(dev_data)
                 else:
                     log.debug('Data received: {!r}'.format(dev_data))
-        except Exception as e:
-            log.debug("Error XX: {} {} {}".format(e, data ,dev_data))
+            if waiters or self.acked or self.waiting:
+                self._resolve(waiters, rcvdata, dev_data, cmdbyte == STATUSCMD, seqno)
+
+    def deliver_changes(self, dev_data):
+        """Update the status and report only the values that changed, if any.
+
+        Parents with a got_changes(device, changes, timestamp) method receive the changes
+        as a dictionary of (old value, new value), old being None for a new value. Other
+        parents get got_data with the new values only.
+        """
+        last = self.last_status
+        changes = {}
+        for key, val in dev_data.items():
+            if key == "devId":
+                continue
+            old = last.get(key, MISSING)
+            if old != val:
+                changes[key] = (None if old is MISSING else old, val)
+                last[key] = val
+        if not changes:
+            return
+        timestamp = time()
+        log.debug('Changes received: {!r}'.format(changes))
+        for aparent in self.parent:
+            cb = getattr(aparent, "got_changes", None)
+            if cb:
+                cb(self, changes, timestamp)
+            else:
+                data = {"devId": self.devid}
+                for key, (old, val) in changes.items():
+                    data[key] = val
+                aparent.got_data(data)
+
+    def _resolve(self, waiters, rcvdata, dev_data, pushed, seqno):
+        """Resolve the commands answered by this status. That is those with the matching
+        sequence number and, when the device pushed the status, the acknowledged ones and,
+        for a non-zero sequence number, those whose values are all reported. Query replies,
+        e.g. to heartbeats, may predate the commands and resolve only the query they answer.
+        """
+        answered = list(waiters or ())
+        if not pushed:
+            for fut, dps in answered:
+                if not fut.done():
+                    fut.set_result(dev_data)
+            return
+        if self.acked:
+            for x in self.acked.values():
+                answered += x
+        self.acked = None
+        if seqno and self.waiting and isinstance(rcvdata.get("dps"), dict):
+            rcvdps = rcvdata["dps"]
+            for other, x in list(self.waiting.items()):
+                left = []
+                for fut, dps in x:
+                    if dps and self._confirms(dps, rcvdps):
+                        answered.append((fut, dps))
+                    else:
+                        left.append((fut, dps))
+                if left:
+                    self.waiting[other] = left
+                else:
+                    del self.waiting[other]
+        for fut, dps in answered:
+            if not fut.done():
+                fut.set_result(dev_data)
+
+    def _confirms(self, dps, rcvdps):
+        """Whether the reported dps hold all the values set, compared once decoded"""
+        for x, val in dps.items():
+            reported = rcvdps.get(x, MISSING)
+            if reported is MISSING:
+                return False
+            if reported != val and self._decode_dp(x, reported) != self._decode_dp(x, val):
+                return False
+        return True
+
+    def _decode_dp(self, dpid, val):
+        """Decode a dp value through the schema, it is returned as is when it cannot be"""
+        name, decoder = self.dpsdecode.get(dpid, (None, None))
+        if decoder:
+            try:
+                return decoder(self, val)
+            except (KeyError, ValueError, TypeError, IndexError):
+                pass
+        return val
 
     def normalize_data(self, data):
-        """Here we can normalize the way data is presented to the appyaOCSwitch("58063204bcddc281a9c5",'992c28c42da4551c',"192.168.7.160", heartbeat=10)
-dev2.starlication
+        """Here we can normalize the way data is presented to the application. Values
+        have already been converted by the schema decoders.
 
         By default, nothing
         """
@@ -312,48 +929,315 @@ dev2.starlication
     def connection_lost(self, exc):
         if self.hbtask:
             self.hbtask.cancel()
+        if self.scheduler:
+            self.scheduler.remove(self)
         self.transport = None
+        for pending in (self.waiting, self.acked):
+            for waiters in (pending or {}).values():
+                for fut, dps in waiters:
+                    if not fut.done():
+                        fut.set_exception(TuyaException("Connection lost"))
+        self.waiting = None
+        self.acked = None
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        self.coalesced_dps = None
+        self.paused = False
         for aparent in self.parent:
             aparent.unregister(self)
         else:
             log.debug("Connection lost")
+        if self.reconnect:
+            self._schedule_reconnect()
 
     async def heartbeat(self):
         log.debug("HB Started for {}".format(self.devid))
         try:
             while True:
-                if self.disconnect_count == 0:
+                if not self.beat():
                     raise Exception
-                #Get the status
-                self.disconnect_count -= 1
-                self.query()
                 await aio.sleep(self.hb)
                 log.debug("HB Lapsed for {}".format(self.devid))
 
         except:
             self.hbtask = None
         finally:
-            self.seppuku()
+            self.hangup()
             return
 
+    def beat(self):
+        """Send a heartbeat. Returns False, without sending, when the device stopped responding
+        """
+        if self.disconnect_count == 0:
+            return False
+        #Get the status
+        self.disconnect_count -= 1
+        self.query()
+        return True
+
+    def query_frame(self):
+        """The status query frame. It is always the same, so we build it only once.
+        Its sequence number is 0, see aquery for a query with a response.
+        """
+        if self.hbframe is None:
+            self.hbframe = bytes(self.message.encode("get", self.cipher.payload("get", OrderedDict([("devId", self.devid), ("gwId", self.devid)]))))
+        return self.hbframe
+
     def query(self, prop=None):
         """Query some device property
         """
-        payload = self.message.encode("get", OrderedDict([("devId", self.devid), ("gwId", self.devid)]))
-        #log.debug("Sending Data : {}".format(payload))
-        self.transport.write(payload)
+        #log.debug("Sending Data : {}".format(self.query_frame()))
+        self.transport.write(self.query_frame())
 
-    def set(self, values):
+    async def aquery(self, timeout=DFLTTIMEOUT):
+        """Query the device status and wait for the response
+
+        :param timeout: How long to wait for the response, in secs
+        :type timeout: float
+        :returns: the status, as reported to the parents' got_data
+        :rtype: dict
+        :raises asyncio.TimeoutError: when no response came in time
+        """
+        seqno = self.message.next_seqno()
+        self.transport.write(self.message.renumber(self.query_frame(), seqno))
+        return await self.wait_response(seqno, None, timeout)
+
+    def values_to_dps(self, values):
+        """Convert a dictionary of values into dps"""
         dps = {}
-        for x in values:
-            dps['%d'%(self.dpsmap.index(x)+1)] = self.dpsvalmap[self.dpsmap.index(x)](values[x])
-        self.raw_set(dps)
+        dpsencode = self.dpsencode
+        for x, val in values.items():
+            dpid, encoder = dpsencode[x]
+            dps[dpid] = encoder(val) if encoder else val
+        return dps
+
+    def set(self, values):
+        """Set values, returns the sequence number of the command"""
+        return self.set_dps(self.values_to_dps(values))
+
+    async def aset(self, values, timeout=DFLTTIMEOUT):
+        """Set values and wait for the device to acknowledge them
+
+        :param values: The values to set
+        :type values: dict
+        :param timeout: How long to wait for the acknowledgement, in secs
+        :type timeout: float
+        :returns: the status reported by the device after the change
+        :rtype: dict
+        :raises asyncio.TimeoutError: when the device did not acknowledge in time
+        """
+        dps = self.values_to_dps(values)
+        return await self.wait_response(self.set_dps(dps), dps, timeout)
+
+    def set_dps(self, dps):
+        """Set dps. When coalesce or rate is set, or when the transport asked us to pause,
+        the dps are queued with one slot per dp, later values replacing queued ones.
+        Returns the sequence number of the command.
+        """
+        if self.coalesce is None and self.rate is None and not self.paused:
+            seqno = self.raw_set(dps)
+            if self.optimistic is not None:
+                self.optimistic_set(dps, seqno)
+            return seqno
+        if not self.coalesced_dps:
+            self.coalesced_seqno = self.message.next_seqno()
+            self.coalesced_dps = {}
+        else:
+            #Stale values that will never be sent
+            self.dropped += sum(1 for x in dps if x in self.coalesced_dps)
+        self.coalesced_dps.update(dps)
+        if self.optimistic is not None:
+            self.optimistic_set(dps, self.coalesced_seqno)
+        self._schedule_flush()
+        return self.coalesced_seqno
+
+    def optimistic_set(self, dps, seqno):
+        """Write the values being set into last_status right away. They stay pending until a
+        status confirms them, and are rolled back if the device does not confirm them within
+        optimistic secs, or reports another value after acknowledging the command.
+        """
+        if self.pending is None:
+            self.pending = {}
+            self.pending_handles = {}
+        last = self.last_status
+        dpsdecode = self.dpsdecode
+        replaced = set()
+        for dpid, val in dps.items():
+            try:
+                name, decoder = dpsdecode[dpid]
+            except KeyError:
+                continue
+            val = decoder(self, val) if decoder else val
+            entry = self.pending.get(name)
+            if entry:
+                reported = entry[1]
+                replaced.add(entry[2])
+            else:
+                reported = last.get(name, MISSING)
+            self.pending[name] = [val, reported, seqno, False]
+            last[name] = val
+        if seqno not in self.pending_handles:
+            self.pending_handles[seqno] = self.loop.call_later(self.optimistic, self._pending_timeout, seqno)
+        for x in replaced:
+            self._release_pending(x)
+
+    def reconcile(self, dev_data):
+        """Confirm, or roll back, the pending values reported in dev_data. A value that differs
+        from the one set, before the device acknowledged the command, is stale and removed from
+        dev_data. Otherwise the value is restored to what the device last reported, so the
+        change is reported as usual.
+        """
+        last = self.last_status
+        rolledback = {}
+        seqnos = set()
+        for name, entry in list(self.pending.items()):
+            if name not in dev_data:
+                continue
+            val = dev_data[name]
+            expected, reported, seqno, acked = entry
+            if val != expected and not acked:
+                entry[1] = val
+                del dev_data[name]
+                continue
+            del self.pending[name]
+            seqnos.add(seqno)
+            if reported is MISSING:
+                del last[name]
+            else:
+                last[name] = reported
+            if val != expected:
+                rolledback[name] = (expected, val)
+        for x in seqnos:
+            self._release_pending(x)
+        if rolledback:
+            self.rolled_back(rolledback)
+
+    def _release_pending(self, seqno):
+        for entry in self.pending.values():
+            if entry[2] == seqno:
+                return
+        handle = self.pending_handles.pop(seqno, None)
+        if handle:
+            handle.cancel()
+
+    def _pending_timeout(self, seqno):
+        self.pending_handles.pop(seqno, None)
+        last = self.last_status
+        rolledback = {}
+        for name, entry in list(self.pending.items()):
+            if entry[2] != seqno:
+                continue
+            del self.pending[name]
+            if entry[1] is MISSING:
+                del last[name]
+                rolledback[name] = (entry[0], None)
+            else:
+                last[name] = entry[1]
+                rolledback[name] = (entry[0], entry[1])
+        if rolledback:
+            self.rolled_back(rolledback)
+
+    def rolled_back(self, values):
+        """Report the values rolled back, as a dictionary of (value set, value reported)"""
+        log.debug("Rolled back {}: {!r}".format(self.devid, values))
+        for aparent in self.parent:
+            #Optional parent method
+            cb = getattr(aparent, "got_rollback", None)
+            if cb:
+                cb(self, values)
 
-    def raw_set(self, dps):
-        payload = OrderedDict([("devId", self.devid), ("uid", ''), ("t", str(round(time()))), ("dps", dps)])
-        payload, md5 = self.cipher.encrypt(payload)
-        payload = self.message.encode("set",self.cipher.version+md5+payload)
-        self.transport.write(payload)
+    def _schedule_flush(self):
+        if self.flush_handle or self.paused:
+            return
+        delay = self.coalesce or 0
+        if self.rate:
+            delay = max(delay, self._token_wait())
+        if delay:
+            self.flush_handle = self.loop.call_later(delay, self.flush)
+        elif self.coalesce is None:
+            self.flush()
+        else:
+            self.flush_handle = self.loop.call_soon(self.flush)
+
+    def _token_wait(self):
+        """Refill the token bucket and return how long until a token is available"""
+        now = self.loop.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.tokens_time) * self.rate)
+        self.tokens_time = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def flush(self):
+        """Send the queued dps now, or as soon as the rate limit and the transport allow"""
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.coalesced_dps or not self.transport or self.paused:
+            return
+        if self.rate:
+            wait = self._token_wait()
+            if wait:
+                self.flush_handle = self.loop.call_later(wait, self.flush)
+                return
+            self.tokens -= 1
+        dps, self.coalesced_dps = self.coalesced_dps, None
+        self.raw_set(dps, self.coalesced_seqno)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        if self.coalesced_dps:
+            self._schedule_flush()
+
+    def raw_set(self, dps, seqno=None):
+        """Set dps, returns the sequence number of the command"""
+        if seqno is None:
+            seqno = self.message.next_seqno()
+        self.transport.write(self.set_frame(dps, seqno))
+        return seqno
+
+    def set_frame(self, dps, seqno, timestamp=None):
+        """Build, without sending, the frame setting dps"""
+        if timestamp is None:
+            timestamp = str(round(time()))
+        payload = OrderedDict([("devId", self.devid), ("uid", ''), ("t", timestamp), ("dps", dps)])
+        return self.message.encode("set", self.cipher.payload("set", payload), seqno)
+
+    async def araw_set(self, dps, timeout=DFLTTIMEOUT):
+        """Set dps and wait for the device to acknowledge them, see aset"""
+        return await self.wait_response(self.raw_set(dps), dps, timeout)
+
+    async def wait_response(self, seqno, dps, timeout=DFLTTIMEOUT):
+        """Wait for the response to the command with the given sequence number.
+
+        :param seqno: The sequence number of the command
+        :type seqno: int
+        :param dps: The dps set by the command, if any. A pushed status reporting all of them, with
+            the values set, also answers the command.
+        :type dps: dict
+        :param timeout: How long to wait, in secs
+        :type timeout: float
+        :returns: the status
+        :rtype: dict
+        """
+        fut = self.loop.create_future()
+        waiter = (fut, dps)
+        if self.waiting is None:
+            self.waiting = {}
+        self.waiting.setdefault(seqno, []).append(waiter)
+        try:
+            return await aio.wait_for(fut, timeout)
+        finally:
+            for pending in (self.waiting, self.acked):
+                waiters = pending.get(seqno) if pending else None
+                if waiters and waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del pending[seqno]
 
     def add_parent(self,parent):
         if not isinstance(parent,list):
@@ -361,13 +1245,23 @@ dev2.starlication
         else:
             self.parent += parent
 
-    def seppuku(self):
-        """Japanese for ritual disembowelment. Also know as Hara-Kiri
-        """
+    def hangup(self):
+        """Close the connection. If reconnect is set, we will reconnect"""
         if self.transport:
             self.transport.close()
         self.transport = None
 
+    def seppuku(self):
+        """Japanese for ritual disembowelment. Also know as Hara-Kiri
+        """
+        self.closing = True
+        if self.admission:
+            self.admission.cancel(self)
+        if self.reconnect_handle:
+            self.reconnect_handle.cancel()
+            self.reconnect_handle = None
+        self.hangup()
+
     def close(self):
         """For ignoramus who cannot remember seppuku.
         """
@@ -396,8 +1290,9 @@ class TuyaSwitch(TuyaDevice):
         :rtype: DatagramProtocol
     """
 
-    dpsmap = ["power"]
-    dpsvalmap = [ lambda x: True if x in [True, 1, "on","On","ON", "oN"] else False ]
+    __slots__ = ()
+
+    dpsschema = [(1, "power", lambda x: x in ONVALUES, lambda dev, x: "on" if x else "off")]
 
     def on(self):
          self.set({"power": True})
@@ -417,16 +1312,6 @@ class TuyaSwitch(TuyaDevice):
         except:
             return None
 
-    def normalize_data(self, data):
-        """Here we can normalize the way data is presented to the application
-
-        By default, nothing
-        """
-        if "power" in data:
-            data["power"] = "on" if data["power"] else "off"
-
-        return data
-
 
 class TuyaOCSwitch(TuyaDevice):
     """Connection to a given Tuya Open/Close/Idle device.
@@ -445,8 +1330,16 @@ class TuyaOCSwitch(TuyaDevice):
         :rtype: DatagramProtocol
     """
 
-    dpsmap = ["state"]
-    dpsvalmap = [ lambda x: str(1+["open","close","idle"].index(x.lower())) ]
+    __slots__ = ("inverted",)
+
+    def _decode_state(self, value):
+        if value == '2':
+            return "opening" if self.inverted else "closing"
+        elif value == '1':
+            return "closing" if self.inverted else "opening"
+        return "idling"
+
+    dpsschema = [(1, "state", lambda x: OCSTATES[x.lower()], _decode_state)]
 
     def __init__(self,devid, key, ip_addr, port=DFLTPORT, parent=[], vers=DFLTVERS, heartbeat=10, invert = False):
         super().__init__(devid, key, ip_addr, port, parent, vers, heartbeat)
@@ -487,30 +1380,6 @@ class TuyaOCSwitch(TuyaDevice):
         """
         self.idle()
 
-    def normalize_data(self, data):
-        """Here we can normalize the way data is presented to the application
-
-        By default, nothing
-        """
-        if "state" in data:
-            if data["state"] == '2':
-                if self.inverted:
-                    data["state"]="opening"
-                else:
-                    data["state"]="closing"
-            elif data["state"] == '1':
-                if self.inverted:
-                    data["state"]="closing"
-                else:
-                    data["state"]="opening"
-            else:
-                data["state"]="idling"
-
-        return data
-
-
-
-
 
 class TuyaLight(TuyaDevice):
     """Connection to a given Tuya Open/Close/Idle device.
@@ -528,56 +1397,85 @@ class TuyaLight(TuyaDevice):
         :returns: an asyncio DatagramProtocol to handle communication with the device
         :rtype: DatagramProtocol
     """
+    __slots__ = ("transition", "last_white", "last_colour")
+
     maxk = 9000
     mink = 2000
-    dpsmap = ["power", "mode", "brightness","temperature","colour"] #
-    dpsvalmap = [ lambda x: True if x in [True, 1, "on","On","ON", "oN"] else False,
-                 lambda x: x.lower() if x.lower() in ['white','colour','scene','scene_1','scene_2','scene_3','scene_4'] else 'white',
-                 lambda x: x if x in range(25,256) else min(max(x,25),255),
-                 lambda x: round((((min(x,TuyaLight.maxk) - TuyaLight.mink)*255)/(TuyaLight.maxk - TuyaLight.mink)) if x >= TuyaLight.mink else 0),
-                 lambda x: TuyaLight.hsv_to_tuya(x)
+    #Tuya colour strings by (h, s, v), see hsv_to_tuya
+    colourcache = {}
+    dpsschema = [(1, "power", lambda x: x in ONVALUES, lambda dev, x: "On" if x else "Off"),
+                 (2, "mode", lambda x: x.lower() if x.lower() in LIGHTMODES else 'white', None),
+                 (3, "brightness", lambda x: min(max(x,25),255), None),
+                 (4, "temperature", lambda x: round((((min(x,TuyaLight.maxk) - TuyaLight.mink)*255)/(TuyaLight.maxk - TuyaLight.mink)) if x >= TuyaLight.mink else 0),
+                     lambda dev, x: dev.mink + round(((dev.maxk-dev.mink) * x)/255)),
+                 (5, "colour", lambda x: TuyaLight.hsv_to_tuya(x), lambda dev, x: TuyaLight.tuya_to_hsv(x))
                  ]
 
 
     def __init__(self,devid, key, ip_addr, port=DFLTPORT, parent=[], vers=DFLTVERS, heartbeat=10):
         super().__init__(devid, key, ip_addr, port, parent, vers, heartbeat)
         self.transition = None
-        self.last_white = [50, 6500]
-        self.last_colour = [180, 50, 50]
+        self.last_white = (50, 6500)
+        self.last_colour = (180, 50, 50)
 
     @staticmethod
     def hsv_to_tuya(colour):
-        """ Here colour is a list containing h (0-360), s (0-100), v (0-100)
+        """ Here colour is a list containing h (0-360), s (0-100), v (0-100). Values
+        are rounded, and the results kept in colourcache.
         """
-        rgb = [round(x*255) for x in hsv_to_rgb(*[ x(y) for x,y in zip([lambda x: x/360, lambda x: x/100, lambda x: x/100],colour)])]
-        hsv = [round(x(y)*255) for x,y in zip([lambda x: x/360, lambda x: x/100, lambda x: x/100],colour)]
-        return "".join([ '%02x'%x for x in rgb+[0]+hsv])
+        key = (min(max(round(colour[0]), 0), 360), min(max(round(colour[1]), 0), 100), min(max(round(colour[2]), 0), 100))
+        try:
+            return TuyaLight.colourcache[key]
+        except KeyError:
+            pass
+        h, s, v = key
+        #As colorsys.hsv_to_rgb does it, so we get the very same bytes
+        i, f = HUESECTOR[h]
+        s /= 100.0
+        v /= 100.0
+        p = round(v*(1.0 - s)*255)
+        q = round(v*(1.0 - s*f)*255)
+        t = round(v*(1.0 - s*(1.0 - f))*255)
+        v = round(v*255)
+        rgb = ((v, t, p), (q, v, p), (p, v, t), (p, q, v), (t, p, v), (v, p, q))[i]
+        result = HEXBYTE[rgb[0]] + HEXBYTE[rgb[1]] + HEXBYTE[rgb[2]] + "00" + HUEBYTE[h] + PCTBYTE[key[1]] + PCTBYTE[key[2]]
+        if len(TuyaLight.colourcache) >= COLOURCACHESIZE:
+            TuyaLight.colourcache.clear()
+        TuyaLight.colourcache[key] = result
+        return result
 
     @staticmethod
     def rgb_to_tuya(colour):
         """ Here colour is a list containing r (0-255), g (0-255), b (0-255)
         """
-        rgb = colour
-        hsv = [round(x*255) for x in rgb_to_hsv(*map(lambda x: x/255,colour))]
-        return "".join(["%02x"%x for x in rgb+[0]+hsv])
+        h, s, v = rgb_to_hsv(colour[0]/255, colour[1]/255, colour[2]/255)
+        return HEXBYTE[colour[0]] + HEXBYTE[colour[1]] + HEXBYTE[colour[2]] + "00" + \
+            HEXBYTE[round(h*255)] + HEXBYTE[round(s*255)] + HEXBYTE[round(v*255)]
 
     @staticmethod
     def tuya_to_hsv(colour):
         """ Colour is a string with rrggbb00hhssvv. With hex values.
         """
-        hsvstr = colour[-6:]
-        result = []
-        result.append( round((int(hsvstr[0:2],16)*360)/255))
-        result.append( round((int(hsvstr[2:4],16)*100)/255))
-        result.append( round((int(hsvstr[4:6],16)*100)/255))
-        return result
+        return [BYTEHUE[BYTEHEX[colour[-6:-4]]], BYTEPCT[BYTEHEX[colour[-4:-2]]], BYTEPCT[BYTEHEX[colour[-2:]]]]
 
     @staticmethod
     def tuya_to_rgb(colour):
         """ Colour is a string with rrggbb00hhssvv. With hex values.
         """
-        hsvstr = colour[:6]
-        return [int(hsvstr[x:x+2],16) for x in range(0,len(hsvstr),2)]
+        return [BYTEHEX[colour[0:2]], BYTEHEX[colour[2:4]], BYTEHEX[colour[4:6]]]
+
+    @staticmethod
+    def hsv_to_tuya_many(colours):
+        """ Convert a list of [h, s, v] colours, e.g. one frame of a group fade
+        """
+        hsv_to_tuya = TuyaLight.hsv_to_tuya
+        return [hsv_to_tuya(x) for x in colours]
+
+    @staticmethod
+    def tuya_to_hsv_many(colours):
+        """ Convert a list of rrggbb00hhssvv strings
+        """
+        return [[BYTEHUE[BYTEHEX[x[-6:-4]]], BYTEPCT[BYTEHEX[x[-4:-2]]], BYTEPCT[BYTEHEX[x[-2:]]]] for x in colours]
 
     def on(self):
         if self.last_status["mode"] == "white":
@@ -618,154 +1516,328 @@ class TuyaLight(TuyaDevice):
 
     def fadein_white(self, bright, temp, duration=3.0):
         """Fade in white with duration"""
-        xx = self.loop.create_task(self._white_transition([25, temp], [bright, temp], duration))
+        return self._transition("white", (25, temp), (bright, temp), duration)
 
     def fadeout_white(self, duration=3.0):
-        """Fade in white with duration"""
-        self.last_white= [self.last_status["brightness"], self.last_status["temperature"]]
-        xx = self.loop.create_task(self._white_transition(self.last_white, [25, self.last_white[1]], duration))
+        """Fade out white with duration"""
+        self.last_white= (self.last_status["brightness"], self.last_status["temperature"])
+        return self._transition("white", self.last_white, (25, self.last_white[1]), duration)
 
     def transition_white(self, end, duration):
+        """Transition from the current white to end, [brightness, K]"""
+        return self._transition("white", (self.last_status["brightness"], self.last_status["temperature"]), end, duration)
+
+    def fadein_colour(self, colour, duration=3.0):
+        """Fade in colour with duration"""
+        return self._transition("colour", (colour[0], colour[1], 0), colour, duration)
 
-        xx = self.loop.create_task(self._white_transition([self.last_status["brightness"], self.last_status["temperature"]], end, duration))
+    def fadeout_colour(self, duration=3.0):
+        """Fade out colour with duration"""
+        self.last_colour= self.last_status["colour"]
+        return self._transition("colour", self.last_colour, (self.last_colour[0],self.last_colour[1], 0), duration)
 
+    def transition_colour(self, end, duration):
+        """Transition from the last colour to end, [h, s, v]"""
+        return self._transition("colour", self.last_colour, end, duration)
 
-    async def _white_transition(self, start, end, duration):
-        log.debug("\n\nWhite transition {} {} {}".format(start, end, duration))
-        if start[0] == end[0] and start[1] == end[1]:
-            await aio.sleep(0)
-            if end[0]<= 25:
-                self.off()
-            else:
-                self.set_white(end[0],end[1])
-            return
-        cnt = 3
-        log.debug("White trans {} {}".format(self.devid, self.transition))
-        if self.transition is True:
-            self.transition = False
-            while not self.transition is None:
-                log.debug("White trans wait")
-                await aio.sleep(0.1)
-                cnt -=1
-                if not cnt:
-                    return
+    def _transition(self, kind, start, end, duration):
+        """Hand the transition over to the loop transition engine. Any running transition
+        on this light is replaced. Returns the transition handle.
+        """
+        log.debug("{} transition {} {} {}".format(kind, start, end, duration))
+        return TuyaTransitions.get(self.loop).start(self, kind, start, end, duration)
 
-        elif self.transition is False:
-            return
 
-        self.transition =  True
+class TuyaTransition():
+    """A running light transition, as returned by the TuyaLight transition methods.
 
-        steps = round(duration*5)  #We send every 0.2 secs
-        for x in range(steps+1):
-            if self.transition is False or self.transport is None:
-                self.transition = None
-                return
-            b = start[0] + round(((end[0]-start[0])*x)/steps)
-            t = start[1] + round(((end[1]-start[1])*x)/steps)
-            self.set_white(b, t)
-            await aio.sleep(0.2)
+    The value at fraction frac (0 to 1) of the transition is computed by step,
+    finish sends the end value.
+    """
 
-        self.set_white(end[0], end[1])
-        if end[0]<= 25:
-            self.off()
-        self.transition =  None
+    __slots__ = ("engine", "device", "kind", "start", "end", "t0", "duration", "hdelta")
+
+    def __init__(self, engine, device, kind, start, end, t0, duration):
+        self.engine = engine
+        self.device = device
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.t0 = t0
+        self.duration = duration
+        #Hue goes the shortest way around
+        self.hdelta = ((end[0] - start[0] + 180) % 360) - 180 if kind == "colour" else 0
+
+    @property
+    def active(self):
+        return self.engine.active.get(self.device) is self
+
+    def cancel(self):
+        """Stop the transition where it is"""
+        self.engine.remove(self)
+
+    def step(self, frac):
+        start, end = self.start, self.end
+        if self.kind == "white":
+            self.device.set_white(start[0] + round((end[0]-start[0])*frac), start[1] + round((end[1]-start[1])*frac))
+        else:
+            self.device.set_colour([round(start[0] + self.hdelta*frac) % 360,
+                                    start[1] + round((end[1]-start[1])*frac),
+                                    start[2] + round((end[2]-start[2])*frac)])
+
+    def finish(self):
+        end = self.end
+        if self.kind == "white":
+            self.device.set_white(end[0], end[1])
+            if end[0] <= 25:
+                self.device.set({"power": False})
+        else:
+            self.device.set_colour(list(end))
+            if end[2] <= 1:
+                self.device.set({"power": False})
 
 
-    def fadein_colour(self, colour, duration=3.0):
-        """Fade in white with duration"""
-        xx = self.loop.create_task(self._colour_transition([colour[0], colour[1], 0], colour, duration))
+class TuyaTransitions():
+    """Transition engine. All the running transitions are driven by a single frame clock,
+    each frame computing and sending the value of every transition. Frames are aligned on
+    multiples of period, and transitions start on a frame, so lights started together
+    change together.
 
-    def fadeout_colour(self, duration=3.0):
-        """Fade in white with duration"""
-        self.last_colour= self.last_status["colour"]
-        xx = self.loop.create_task(self._colour_transition(self.last_colour, [self.last_colour[0],self.last_colour[1], 0], duration))
+        :param loop: The asyncio loop
+        :type loop: asyncio.AbstractEventLoop
+        :param period: Time between frames, in secs
+        :type period: float
+    """
 
+    #One engine per loop with running transitions, see get
+    engines = {}
 
-    def transition_colour(self, end, duration):
+    def __init__(self, loop, period=TRANSPERIOD):
+        self.loop = loop
+        self.period = period
+        #The running transition of each device
+        self.active = {}
+        self.handle = None
+
+    @classmethod
+    def get(cls, loop):
+        """Return the engine for this loop, creating it if needed. Engines are dropped when
+        they go idle, or when their loop was closed with transitions still running.
+        """
+        try:
+            return cls.engines[loop]
+        except KeyError:
+            for x in [x for x in cls.engines if x.is_closed()]:
+                del cls.engines[x]
+            engine = cls.engines[loop] = cls(loop)
+            return engine
+
+    def next_frame(self):
+        return (self.loop.time() // self.period + 1) * self.period
+
+    def start(self, dev, kind, start, end, duration):
+        """Start a transition on dev, replacing the running one if any
+
+        :param dev: The light
+        :type dev: TuyaLight
+        :param kind: "white" or "colour"
+        :type kind: str
+        :param start: The start value, [brightness, K] or [h, s, v]
+        :type start: list
+        :param end: The end value
+        :type end: list
+        :param duration: The duration of the transition, in secs
+        :type duration: float
+        :returns: the transition
+        :rtype: TuyaTransition
+        """
+        if tuple(start) == tuple(end):
+            duration = 0
+        trans = TuyaTransition(self, dev, kind, tuple(start), tuple(end), self.next_frame(), duration)
+        self.active[dev] = trans
+        dev.transition = trans
+        if self.handle is None:
+            self.handle = self.loop.call_at(trans.t0, self._frame, trans.t0)
+        return trans
+
+    def remove(self, trans):
+        if self.active.get(trans.device) is trans:
+            del self.active[trans.device]
+            trans.device.transition = None
+        if not self.active:
+            if self.handle:
+                self.handle.cancel()
+                self.handle = None
+            if self.engines.get(self.loop) is self:
+                del self.engines[self.loop]
+
+    def _frame(self, when):
+        finished = []
+        for dev, trans in list(self.active.items()):
+            if dev.transport is None:
+                self.remove(trans)
+                continue
+            frac = (when - trans.t0) / trans.duration if trans.duration > 0 else 1
+            if frac >= 1:
+                finished.append(trans)
+            elif frac >= 0:
+                trans.step(frac)
+        for trans in finished:
+            self.remove(trans)
+            trans.finish()
+        if self.active:
+            when += self.period
+            self.handle = self.loop.call_at(when, self._frame, when)
+        else:
+            self.handle = None
 
-        xx = self.loop.create_task(self._colour_transition(self.last_colour, end, duration))
 
-    async def _colour_transition(self, start, end, duration):
-        log.debug("\n\nColour transition {} {} {}".format(start, end, duration))
-        if start[0] == end[0] and start[1] == end[1] and start[2] == end[2]:
-            await aio.sleep(0)
-            if end[2] <= 0:
-                self.off()
-            return
-        cnt = 3
-        if self.transition is True:
-            self.transition = False
-            while not self.transition is None:
-                await aio.sleep(0.1)
-                cnt -=1
-                if not cnt:
-                    return
+class TuyaGroup():
+    """A group of devices controlled together, e.g. the lights of a room.
 
-        elif self.transition is False:
-            return
+    apply builds the frames for all the devices first, then writes them all in the same
+    loop iteration, so the devices change together. aapply also waits for the devices to
+    acknowledge and reports how long each one took.
 
-        self.transition =  True
+        :param devices: The devices
+        :type devices: list
+    """
 
-        steps = round(duration*5)  #We send every 0.2 secs
-        log.debug("Steps is {}".format(steps))
-        if start[0] > end[0]:
-            if start[0] - end[0] < 180:
-                #we go negative
-                hdelta = round((end[0] - start[0])/steps)
-            else:
-                hdelta = round((end[0] - start[0] + 360)/steps)
-        else:
+    def __init__(self, devices=[]):
+        self.devices = list(devices)
+        #Response time of each device to the last aapply, None when it did not respond
+        self.latency = {}
+        #Time between the first and the last device to respond to the last aapply
+        self.skew = None
 
-            if end[0] - start[0] < 180:
-                hdelta = round((end[0] - start[0])/steps)
-            else:
-                hdelta = 0 - round((start[0] - end[0] + 360)/steps)
+    def add(self, dev):
+        if dev not in self.devices:
+            self.devices.append(dev)
 
-        log.debug("hdelta is {}".format(hdelta))
-        for x in range(steps):
-            if self.transition is False:
-                self.transition = None
-                return
-            h = (start[0] + hdelta*x)%360
-            s = start[1] + round(((end[1]-start[1])*x)/steps)
-            v = start[2] + round(((end[2]-start[2])*x)/steps)
-            log.debug("Colour to {}".format([h,s,v]))
-            self.set_colour([h,s,v])
-            await aio.sleep(0.2)
+    def remove(self, dev):
+        if dev in self.devices:
+            self.devices.remove(dev)
 
-        self.set_colour(end)
-        if end[2]<= 1:
-            self.off()
-        self.transition =  None
+    def __iter__(self):
+        return iter(self.devices)
 
+    def __len__(self):
+        return len(self.devices)
 
-    def normalize_data(self, data):
-        """Here we can normalize the way data is presented to the application
+    def apply(self, values):
+        """Set values on all the connected devices.
 
-        By default, nothing
+        The values are converted once per device class. When a device cannot take the
+        values, the exception is raised before anything is sent. Devices that queue their
+        commands (coalesce, rate or paused) get the values queued as usual.
+
+        :param values: The values to set
+        :type values: dict
+        :returns: the sequence number of the command sent to each device
+        :rtype: dict
+        """
+        return {dev: seqno for dev, (seqno, dps) in self._send(values).items()}
+
+    def _send(self, values):
+        dpscache = {}
+        timestamp = str(round(time()))
+        frames = []
+        for dev in self.devices:
+            if dev.transport is None:
+                continue
+            try:
+                dps = dpscache[dev.__class__]
+            except KeyError:
+                dps = dpscache[dev.__class__] = dev.values_to_dps(values)
+            if dev.coalesce is None and dev.rate is None and not dev.paused:
+                seqno = dev.message.next_seqno()
+                frames.append((dev, seqno, dps, dev.set_frame(dps, seqno, timestamp)))
+            else:
+                frames.append((dev, None, dps, None))
+        sent = {}
+        for dev, seqno, dps, frame in frames:
+            if frame is None:
+                seqno = dev.set_dps(dps)
+            else:
+                dev.transport.write(frame)
+                if dev.optimistic is not None:
+                    dev.optimistic_set(dps, seqno)
+            sent[dev] = (seqno, dps)
+        return sent
+
+    async def aapply(self, values, timeout=DFLTTIMEOUT):
+        """Set values on all the connected devices and wait, at most timeout secs overall, for
+        them to acknowledge. Per device response times are left in latency, and the time
+        between the first and the last response in skew.
+
+        :param values: The values to set
+        :type values: dict
+        :param timeout: How long to wait for the devices, in secs
+        :type timeout: float
+        :returns: the status reported by each device that responded in time
+        :rtype: dict
         """
-        if "power" in data:
-            data["power"] = data["power"] and "On" or "Off"
-        if "temperature" in data:
-            data["temperature"] = self.mink + round(((self.maxk-self.mink) * data["temperature"])/255)
-        if "colour" in data:
-            data["colour"] = TuyaLight.tuya_to_hsv(data["colour"])
+        loop = aio.get_event_loop()
+        start = loop.time()
+        sent = self._send(values)
+        self.latency = {}
+        self.skew = None
+        if not sent:
+            return {}
+
+        async def wait_one(dev, seqno, dps):
+            status = await dev.wait_response(seqno, dps, timeout)
+            self.latency[dev] = loop.time() - start
+            return status
+
+        waiters = []
+        for dev, (seqno, dps) in sent.items():
+            self.latency[dev] = None
+            waiters.append(wait_one(dev, seqno, dps))
+        results = await aio.gather(*waiters, return_exceptions=True)
+        status = {}
+        for dev, result in zip(sent, results):
+            if isinstance(result, Exception):
+                log.debug("No response from {} to group command: {!r}".format(dev.devid, result))
+            else:
+                status[dev] = result
+        times = [x for x in self.latency.values() if x is not None]
+        if times:
+            self.skew = max(times) - min(times)
+        return status
 
-        return data
 
+class TuyaScanner(aio.DatagramProtocol):
+    """This will monitor UDP broadcast from Tuya devices
 
+    Devices using protocol 3.1 broadcast in clear on port, those using 3.3 broadcast on
+    encrypted_port, encrypted with a well known key. Set encrypted_port to None to only listen
+    on port.
 
-class TuyaScanner(aio.DatagramProtocol):
-    """This will monitor UDP broadcast from Tuya devices"""
+    Devices repeat the very same broadcast every few secs. A broadcast seen less than ttl
+    secs ago is dropped before being parsed. The last cache_size broadcasts are remembered,
+    with what they decoded to, so they are not parsed or decrypted again when they come
+    back after ttl secs. hits and misses count the broadcasts dropped and parsed.
+    """
 
-    def __init__(self, parent= None,ip='0.0.0.0', port=6666):
+    def __init__(self, parent= None,ip='0.0.0.0', port=6666, ttl=SCANTTL, cache_size=SCANCACHE, encrypted_port=6667):
         self.ip = ip
         self.port = port
+        self.encrypted_port = encrypted_port
         self.loop = None
         self.message = TuyaMessage()
+        self.emessage = TuyaMessage(cipher=TuyaCipher.get(UDPKEY, "3.3"))
         self.task = None
+        self.etask = None
         self.parent = parent
         self.transport = None
+        self.etransport = None
+        self.ttl = ttl
+        self.cache_size = cache_size
+        #Broadcasts seen, with their expiry time and decoded data, least recently seen first
+        self.seen = OrderedDict()
+        self.hits = 0
+        self.misses = 0
 
     def connection_made(self, transport):
         log.debug("Scanner Connected")
@@ -775,12 +1847,43 @@ class TuyaScanner(aio.DatagramProtocol):
         #sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
 
     def datagram_received(self, rdata, addr):
-        resu =self.message.parse(rdata)
-        for code, data in resu:
+        self.received(rdata, self.message)
+
+    def received(self, rdata, message):
+        """Process a broadcast, decoded with message"""
+        entry = None
+        if self.cache_size:
+            now = self.loop.time()
+            entry = self.seen.get(rdata)
+            if entry is not None:
+                self.seen.move_to_end(rdata)
+                if entry[0] > now:
+                    self.hits += 1
+                    return
+                entry[0] = now + self.ttl
+        if entry is None:
+            self.misses += 1
+            resu = []
+            for code, data, seqno in message.parse(rdata):
+                if code:
+                    log.debug('Bad broadcast: {} {}'.format(code, data))
+                else:
+                    resu.append(data)
+            if self.cache_size:
+                self.seen[rdata] = [now + self.ttl, resu]
+                if len(self.seen) > self.cache_size:
+                    self.seen.popitem(last=False)
+        else:
+            resu = entry[1]
+        for data in resu:
             log.debug('broadcast received: {}'.format(data))
             if self.parent:
                 self.parent.notify(data)
 
+    def forget(self):
+        """Forget the broadcasts seen, e.g. after learning new keys"""
+        self.seen.clear()
+
     def start(self, loop):
         """Starting the control of the device
         """
@@ -789,12 +1892,489 @@ class TuyaScanner(aio.DatagramProtocol):
             lambda: self, local_addr= (self.ip, self.port))
 
         self.task = self.loop.create_task(coro)
+        if self.encrypted_port:
+            coro = self.loop.create_datagram_endpoint(
+                lambda: TuyaEncryptedScanner(self), local_addr= (self.ip, self.encrypted_port))
+            self.etask = self.loop.create_task(coro)
         return self.task
 
     def close(self):
         if self.transport:
             self.transport.close()
             self.transport = None
+        if self.etransport:
+            self.etransport.close()
+            self.etransport = None
+
+
+class TuyaEncryptedScanner(aio.DatagramProtocol):
+    """Receives the encrypted broadcasts for a TuyaScanner"""
+
+    def __init__(self, scanner):
+        self.scanner = scanner
+
+    def connection_made(self, transport):
+        log.debug("Encrypted Scanner Connected")
+        self.scanner.etransport = transport
+
+    def datagram_received(self, rdata, addr):
+        self.scanner.received(rdata, self.scanner.emessage)
+
+
+class TuyaSweep:
+    """Active discovery. Every host of a network is probed on the device port, by concurrency
+    workers, skipping the addresses of the devices already connected. Hosts accepting the
+    connection are sent a status query, the answer tells which device it is: 3.1 devices
+    answer in clear, 3.3 answers are decrypted with the keys of the known devices that are
+    not running. Each device found is passed to the parent notify, as a broadcast would be.
+
+        :param parent: The object notified, usually a TuyaManager
+        :type parent: object
+        :param network: The network to sweep, e.g. "192.168.1.0/24"
+        :type network: str
+        :param port: The device port
+        :type port: int
+        :param concurrency: How many hosts are probed at once
+        :type concurrency: int
+        :param timeout: How long to wait for a host to accept the connection, and then to answer, in secs
+        :type timeout: float
+    """
+
+    def __init__(self, parent, network, port=DFLTPORT, concurrency=SWEEPCONC, timeout=SWEEPTIMEOUT):
+        self.parent = parent
+        self.network = ipaddress.ip_network(network, strict=False)
+        self.port = port
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.query = bytes(TuyaMessage().encode("get", {"gwId": "", "devId": ""}))
+        self.candidates = []
+        #Addresses of the devices already connected, not probed
+        self.busy = set()
+        #Number of hosts accepting the connection, and the devices found
+        self.open = 0
+        self.found = []
+
+    async def run(self):
+        """Sweep the network
+
+        :returns: the devices found, as dict with gwId, ip and version
+        :rtype: list
+        """
+        known = getattr(self.parent, "known_devices", {})
+        running = getattr(self.parent, "running_devices", {})
+        self.candidates = [(devid, key) for devid, key in known.items() if devid not in running]
+        #Devices usually accept a single connection, leave the connected ones alone
+        registry = getattr(self.parent, "registry", None)
+        self.busy = set()
+        if registry is not None:
+            self.busy = {ip for ip, devids in registry.by_ip.items()
+                         if any(registry.devices[x].transport for x in devids)}
+        self.open = 0
+        self.found = []
+        hosts = iter(self.network.hosts())
+        await aio.gather(*[self._worker(hosts) for x in range(self.concurrency)])
+        return self.found
+
+    async def _worker(self, hosts):
+        #The workers share the host iterator
+        for ip in hosts:
+            ip = str(ip)
+            if ip not in self.busy:
+                await self.probe(ip)
+
+    async def probe(self, ip):
+        try:
+            reader, writer = await aio.wait_for(aio.open_connection(ip, self.port), self.timeout)
+        except (OSError, aio.TimeoutError):
+            return None
+        self.open += 1
+        try:
+            writer.write(self.query)
+            resu = await aio.wait_for(self._response(reader), self.timeout)
+        except (OSError, aio.TimeoutError):
+            resu = b""
+        finally:
+            writer.close()
+        data = self.identify(resu)
+        if data:
+            data["ip"] = ip
+            log.debug("Sweep found {}".format(data))
+            self.found.append(data)
+            if self.parent:
+                self.parent.notify(data)
+        return data
+
+    async def _response(self, reader):
+        #The bytes received, up to the first complete frame
+        message = TuyaMessage()
+        received = bytearray()
+        while True:
+            data = await reader.read(1024)
+            if not data:
+                return b""
+            received += data
+            if message.feed(data):
+                return bytes(received)
+
+    def identify(self, data):
+        """Figure out the device from its answer, returns a dict with gwId and version, or None
+
+        :param data: The bytes received from the device
+        :type data: bytes
+        """
+        encrypted = False
+        for code, payload, seqno in TuyaMessage().feed(data):
+            if isinstance(payload, dict):
+                if payload.get("devId"):
+                    return {"gwId": payload["devId"], "version": "3.1"}
+            elif isinstance(payload, bytes):
+                encrypted = True
+        if not encrypted:
+            return None
+        #Decoded again for each key, a 3.3 payload can start with 0x00 bytes, which
+        #are skipped as padding without a binary cipher
+        for devid, key in self.candidates:
+            message = TuyaMessage(cipher=TuyaCipher.get(key, "3.3"))
+            for code, payload, seqno in message.feed(data):
+                if isinstance(payload, dict):
+                    return {"gwId": devid, "version": "3.3"}
+        return None
+
+
+class TuyaHeartbeat:
+    """Heartbeat for many devices, driven by a single timer wheel.
+
+    The wheel has slots slots, one per tick secs. Deadlines are spread with some jitter so
+    devices started together do not stay in lockstep. When a device sent data recently, the
+    poll is skipped. The interval of a device grows, up to HBMAX, as long as it answers
+    every heartbeat and goes back to the device hb as soon as one is missed.
+
+        :param loop: The asyncio loop
+        :type loop: asyncio.AbstractEventLoop
+        :param tick: The wheel resolution, in secs
+        :type tick: float
+        :param jitter: The relative jitter applied to the intervals
+        :type jitter: float
+        :param slots: The number of slots in the wheel
+        :type slots: int
+    """
+
+    def __init__(self, loop, tick=HBTICK, jitter=HBJITTER, slots=HBSLOTS, pace=None):
+        self.loop = loop
+        self.tick = tick
+        self.jitter = jitter
+        #Minimum time between first polls, None to send them right away
+        self.pace = pace
+        #For each slot, the devices and the number of rounds they still have to wait
+        self.wheel = [{} for x in range(slots)]
+        self.cursor = 0
+        #For each device: slot, interval and time of the last poll
+        self.devices = {}
+        self.handle = None
+        self.next_tick = 0
+        #Devices waiting for their first poll, in order
+        self.first = OrderedDict()
+        self.first_handle = None
+
+    def add(self, dev):
+        """Start the heartbeat of a device, the first poll is sent right away, or after the
+        devices added before it when pace is set
+        """
+        self.remove(dev)
+        entry = self.devices[dev] = [None, dev.hb, self.loop.time()]
+        if not self.pace:
+            self._first_poll(dev, entry)
+            return
+        self.first[dev] = entry
+        if self.first_handle is None:
+            self.first_handle = self.loop.call_soon(self._first)
+
+    def _first(self):
+        self.first_handle = None
+        if self.first:
+            self._first_poll(*self.first.popitem(last=False))
+        if self.first:
+            self.first_handle = self.loop.call_later(self.pace, self._first)
+
+    def _first_poll(self, dev, entry):
+        entry[2] = self.loop.time()
+        dev.beat()
+        #Spread the devices started together
+        self._schedule(dev, entry, dev.hb * random.uniform(0.5, 1))
+
+    def remove(self, dev):
+        entry = self.devices.pop(dev, None)
+        if entry:
+            if entry[0] is None:
+                self.first.pop(dev, None)
+            else:
+                self.wheel[entry[0]].pop(dev, None)
+        if not self.devices and self.handle:
+            self.handle.cancel()
+            self.handle = None
+
+    def _schedule(self, dev, entry, delay):
+        ticks = max(1, round(delay / self.tick))
+        slot = (self.cursor + ticks) % len(self.wheel)
+        entry[0] = slot
+        self.wheel[slot][dev] = (ticks - 1) // len(self.wheel)
+        if self.handle is None:
+            self.next_tick = self.loop.time() + self.tick
+            self.handle = self.loop.call_at(self.next_tick, self._tick)
+
+    def _tick(self):
+        self.cursor = (self.cursor + 1) % len(self.wheel)
+        slot = self.wheel[self.cursor]
+        due = []
+        for dev, rounds in list(slot.items()):
+            if rounds:
+                slot[dev] = rounds - 1
+            else:
+                del slot[dev]
+                due.append(dev)
+        now = self.loop.time()
+        for dev in due:
+            self._due(dev, now)
+        if self.devices:
+            self.next_tick += self.tick
+            self.handle = self.loop.call_at(self.next_tick, self._tick)
+        else:
+            self.handle = None
+
+    def _due(self, dev, now):
+        entry = self.devices[dev]
+        interval = entry[1]
+        if now - dev.last_seen < interval * HBRECENT and now - entry[2] < HBMAX:
+            #Data came in recently, no need to ask
+            self._schedule(dev, entry, dev.last_seen + interval - now)
+            return
+
+        if dev.disconnect_count == DISCCNT:
+            #Answered the last poll
+            entry[1] = min(interval * HBGROWTH, max(dev.hb, HBMAX))
+        else:
+            entry[1] = dev.hb
+        if not dev.beat():
+            log.debug("No heartbeat from {}".format(dev.devid))
+            self.remove(dev)
+            dev.hangup()
+            return
+        entry[2] = now
+        self._schedule(dev, entry, entry[1] * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+
+class TuyaAdmission:
+    """Admission control of the device connections. At most limit connections are being
+    established at once, the others wait in line, in order. Devices reconnecting get back in line.
+
+        :param loop: The asyncio loop
+        :type loop: asyncio.AbstractEventLoop
+        :param limit: How many connections can be established at once, None for no limit
+        :type limit: int
+    """
+
+    def __init__(self, loop, limit=MAXCONNECTS):
+        self.loop = loop
+        self.limit = limit
+        #Devices waiting, in order
+        self.queue = OrderedDict()
+        #Devices connecting, with the time they started to, and whether they must start again
+        self.connecting = {}
+        #The last connect times, in secs
+        self.latencies = deque(maxlen=ADMITSAMPLES)
+        self.connected = 0
+        self.failed = 0
+
+    @property
+    def depth(self):
+        """The number of devices waiting"""
+        return len(self.queue)
+
+    @property
+    def connect_latency(self):
+        """The average of the last connect times, in secs"""
+        if not self.latencies:
+            return None
+        return sum(self.latencies) / len(self.latencies)
+
+    def admit(self, dev):
+        """Start the connection to dev, as soon as there is room"""
+        if dev in self.connecting:
+            #e.g. redial while connecting, start again when done
+            self.connecting[dev][1] = True
+            return
+        if dev in self.queue:
+            return
+        self.queue[dev] = None
+        self._next()
+
+    def cancel(self, dev):
+        """Take dev out of the line"""
+        self.queue.pop(dev, None)
+
+    def clear(self):
+        self.queue.clear()
+
+    def _next(self):
+        while self.queue and (self.limit is None or len(self.connecting) < self.limit):
+            dev, x = self.queue.popitem(last=False)
+            if dev.closing:
+                continue
+            self.connecting[dev] = [self.loop.time(), False]
+            dev.start(self.loop).add_done_callback(partial(self._done, dev))
+
+    def _done(self, dev, task):
+        entry = self.connecting.pop(dev, None)
+        if entry is not None:
+            if task.cancelled() or task.exception():
+                self.failed += 1
+            else:
+                self.connected += 1
+                self.latencies.append(self.loop.time() - entry[0])
+            if entry[1] and not dev.closing and not dev.transport:
+                self.queue[dev] = None
+        self._next()
+
+
+class TuyaRegistry:
+    """The devices of a TuyaManager, by device id, indexed by state, IP address and class.
+
+    A device is either "running" or "pending", i.e. being probed to figure out what it is.
+    Ignored devices are only known by id, in ignored.
+    """
+
+    def __init__(self):
+        self.devices = {}
+        #Indexes. For each device id, its state and indexed IP address
+        self.states = {}
+        self.ips = {}
+        #For each device id, its protocol version and, when it reported errors, their number
+        self.versions = {}
+        self.errors = {}
+        self.by_state = {"running": {}, "pending": {}}
+        self.by_ip = {}
+        self.by_class = {}
+        #Parsed IP addresses, for the network queries
+        self.addresses = {}
+        self.ignored = set()
+
+    def __contains__(self, devid):
+        return devid in self.devices
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __iter__(self):
+        return iter(self.devices.values())
+
+    def get(self, devid, default=None):
+        return self.devices.get(devid, default)
+
+    def state(self, devid):
+        """The state of devid, None when unknown"""
+        return self.states.get(devid)
+
+    def add(self, dev, state="running"):
+        """Add dev, replacing the device with the same id if any"""
+        self.remove(dev.devid)
+        self.devices[dev.devid] = dev
+        self.states[dev.devid] = state
+        self.versions[dev.devid] = dev.cipher.version.decode()
+        self.by_state.setdefault(state, {})[dev.devid] = dev
+        self.by_class.setdefault(dev.__class__, set()).add(dev.devid)
+        self._index_ip(dev.devid, dev.ip)
+
+    def remove(self, devid, dev=None):
+        """Remove devid, only if it is dev when given. Returns the device removed"""
+        current = self.devices.get(devid)
+        if current is None or (dev is not None and current is not dev):
+            return None
+        del self.devices[devid]
+        del self.by_state[self.states.pop(devid)][devid]
+        del self.versions[devid]
+        self.errors.pop(devid, None)
+        self._unindex(self.by_class, current.__class__, devid)
+        self._unindex(self.by_ip, self.ips.pop(devid), devid)
+        return current
+
+    def version(self, devid):
+        """The protocol version of devid, None when unknown"""
+        return self.versions.get(devid)
+
+    def error(self, dev):
+        """Count an error of dev. Returns the number of errors so far, 0 when dev is not registered"""
+        if self.devices.get(dev.devid) is not dev:
+            return 0
+        count = self.errors[dev.devid] = self.errors.get(dev.devid, 0) + 1
+        return count
+
+    def set_ip(self, dev, ip):
+        """Change the IP address of dev"""
+        dev.ip = ip
+        if self.devices.get(dev.devid) is dev and self.ips[dev.devid] != ip:
+            self._unindex(self.by_ip, self.ips[dev.devid], dev.devid)
+            self._index_ip(dev.devid, ip)
+
+    def _index_ip(self, devid, ip):
+        self.ips[devid] = ip
+        if ip not in self.by_ip:
+            self.by_ip[ip] = set()
+            try:
+                self.addresses[ip] = ipaddress.ip_address(ip)
+            except ValueError:
+                pass
+        self.by_ip[ip].add(devid)
+
+    def _unindex(self, index, key, devid):
+        devids = index[key]
+        devids.discard(devid)
+        if not devids:
+            del index[key]
+            if index is self.by_ip:
+                self.addresses.pop(key, None)
+
+    def find(self, cls=None, state=None, network=None, ip=None):
+        """Find devices. All the criteria given must match.
+
+        :param cls: The device class, subclasses match too
+        :type cls: class
+        :param state: "running" or "pending"
+        :type state: str
+        :param network: A network, e.g. "192.168.1.0/24"
+        :type network: str
+        :param ip: An IP address
+        :type ip: str
+        :returns: the devices
+        :rtype: list
+        """
+        found = None
+        if ip is not None:
+            found = self.by_ip.get(ip, set())
+        if network is not None:
+            network = ipaddress.ip_network(network, strict=False)
+            devids = set()
+            for addr, x in self.addresses.items():
+                if x in network:
+                    devids |= self.by_ip[addr]
+            found = devids if found is None else found & devids
+        if cls is not None:
+            devids = set()
+            for x, y in self.by_class.items():
+                if issubclass(x, cls):
+                    devids |= y
+            found = devids if found is None else found & devids
+        if state is not None:
+            bystate = self.by_state.get(state, {})
+            if found is None:
+                return list(bystate.values())
+            return [bystate[x] for x in found if x in bystate]
+        if found is None:
+            return list(self.devices.values())
+        return [self.devices[x] for x in found]
+
+    def not_seen(self, secs, now, state="running"):
+        """The devices that sent nothing for secs secs, now being the loop time"""
+        return [dev for dev in self.by_state.get(state, {}).values() if now - dev.last_seen >= secs]
 
 
 class TuyaManager:
@@ -817,18 +2397,57 @@ class TuyaManager:
             with register/unregister/got_data methods
         """
         self.known_devices = knowndevs
-        self.running_devices = {}
-        self.pending_devices = {}
-        self.version_devices = {}
-        self.ignore_devices = []
-        self.error_device = {}
+        #The devices, running and pending, with their protocol version and error count, and
+        #the ignored device ids
+        self.registry = TuyaRegistry()
         self.loop = aio.get_event_loop() if loop is None else loop
         self.dev_parent = dev_parent
+        self.scheduler = TuyaHeartbeat(self.loop, pace=HBPACE)
+        #Connections are established MAXCONNECTS at a time
+        self.admission = TuyaAdmission(self.loop)
+        #When set, running devices reconnect by themselves when the connection is lost
+        self.reconnect = False
+        #When set, running devices only report the values that changed
+        self.changes_only = False
+        #What was learnt about the devices, by device id: class name, protocol version, last IP and
+        #a digest of the key used. Devices with a fingerprint are started as the right class right away.
+        self.fingerprints = {}
+        #The classes fingerprints can refer to, by name
+        self.device_classes = {x.__name__: x for x in (TuyaSwitch, TuyaOCSwitch, TuyaLight)}
         self.load_keys()
+        self.load_fingerprints()
+
+    @property
+    def running_devices(self):
+        """The running devices, by id. Do not modify, see registry"""
+        return self.registry.by_state["running"]
+
+    @property
+    def pending_devices(self):
+        """The devices being probed, by id. Do not modify, see registry"""
+        return self.registry.by_state["pending"]
+
+    @property
+    def version_devices(self):
+        """The protocol version of the devices, by id. Do not modify, see registry"""
+        return self.registry.versions
 
+    @property
+    def ignore_devices(self):
+        """The ids of the devices ignored"""
+        return self.registry.ignored
+
+    def find(self, cls=None, state=None, network=None, ip=None):
+        """Find devices, see TuyaRegistry.find"""
+        return self.registry.find(cls, state, network, ip)
+
+    def not_seen(self, secs):
+        """The running devices that sent nothing for secs secs"""
+        return self.registry.not_seen(secs, self.loop.time())
 
     def notify(self,data):
         dclass = None
+        laststatus = None
         if "gwId" not in data or "ip" not in data:
             #Nothing we can do
             return
@@ -841,55 +2460,163 @@ class TuyaManager:
             if self.running_devices[data["gwId"]].ip == data["ip"] and self.running_devices[data["gwId"]].transport:
                 #No change
                 return
+            dev = self.running_devices[data["gwId"]]
+            if dev in self.admission.queue or dev in self.admission.connecting:
+                #On its way, keep its place in line
+                if dev.ip != data["ip"]:
+                    self.registry.set_ip(dev, data["ip"])
+                    if dev in self.admission.connecting:
+                        #Connecting to the old address
+                        dev.redial()
+                    self.learn(dev)
+                return
+            if self.running_devices[data["gwId"]].reconnect:
+                #The device takes care of it, just make sure it uses the right address
+                if self.running_devices[data["gwId"]].ip != data["ip"]:
+                    self.registry.set_ip(self.running_devices[data["gwId"]], data["ip"])
+                    self.running_devices[data["gwId"]].redial()
+                    self.learn(self.running_devices[data["gwId"]])
+                return
             dclass = self.running_devices[data["gwId"]].__class__
-            self.running_devices[data["gwId"]].seppuku()
-            del(self.running_devices[data["gwId"]])
+            laststatus = self.running_devices[data["gwId"]].last_status
+            self.registry.remove(data["gwId"]).seppuku()
 
         if data["gwId"] in self.pending_devices:
             #Wow!... This sucker broadcasts like crazy... or we have a problem
             self.pending_devices[data["gwId"]].attemps -= 1
             if self.pending_devices[data["gwId"]].attemps == 0:
-                self.pending_devices[data["gwId"]].seppuku()
-                del(self.pending_devices[data["gwId"]])
+                self.registry.remove(data["gwId"]).seppuku()
             return
 
         if data["gwId"] not in self.known_devices:
             #No key.... we are fucked
             return
 
+        fingerprint = self.fingerprint(data["gwId"])
         try:
-            self.version_devices[data["gwId"]] = data["version"]
+            version = data["version"]
         except:
-            self.version_devices[data["gwId"]] = DFLTVERS
+            version = fingerprint["version"] if fingerprint else DFLTVERS
+        if dclass is None and fingerprint:
+            dclass = self.device_classes[fingerprint["class"]]
         #OK... either we know the class or we dpn't
         if dclass:
             #Great we know it
-            self.running_devices[data["gwId"]] = dclass(data["gwId"], self.known_devices[data["gwId"]], data["ip"], parent=self.dev_parent, vers=self.version_devices[data["gwId"]])
-            self.running_devices[data["gwId"]].start( loop = self.loop )
+            self.registry.add(dclass(data["gwId"], self.known_devices[data["gwId"]], data["ip"], parent=self.dev_parent, vers=version))
+            if laststatus is not None:
+                #Keep what we know until the device reports
+                self.running_devices[data["gwId"]].last_status.update(laststatus)
+            self.learn(self.running_devices[data["gwId"]])
+            self.start_device(self.running_devices[data["gwId"]])
         else:
             #First time, we need to figure out what the device is
-            self.pending_devices[data["gwId"]] = TuyaDevice(data["gwId"], self.known_devices[data["gwId"]], data["ip"], parent=[self], vers=self.version_devices[data["gwId"]],heartbeat=2)
+            self.registry.add(TuyaDevice(data["gwId"], self.known_devices[data["gwId"]], data["ip"], parent=[self], vers=version,heartbeat=2), "pending")
             self.pending_devices[data["gwId"]].raw_dps = True
             self.pending_devices[data["gwId"]].attemps = 0
-            self.pending_devices[data["gwId"]].start(self.loop)
+            self.start_device(self.pending_devices[data["gwId"]], pending=True)
+
+    def start_device(self, dev, pending=False):
+        """Start a device created by the manager, its heartbeat is driven by our scheduler.
+        Pending devices, used to figure out the device type, do not reconnect.
+        """
+        dev.scheduler = self.scheduler
+        dev.admission = self.admission
+        dev.reconnect = self.reconnect and not pending
+        dev.changes_only = self.changes_only and not pending
+        self.admission.admit(dev)
+
+    async def sweep(self, network, concurrency=SWEEPCONC, timeout=SWEEPTIMEOUT):
+        """Actively look for the devices on network, without waiting for their broadcasts.
+        See TuyaSweep.
+
+        :returns: the devices found
+        :rtype: list
+        """
+        return await TuyaSweep(self, network, concurrency=concurrency, timeout=timeout).run()
+
+    def group(self, devids):
+        """A TuyaGroup with the running devices among devids"""
+        return TuyaGroup(self.running_devices[x] for x in devids if x in self.running_devices)
 
     def register(self,dev):
         #Avoid overloading.... it will run when a "pending" device connects
         pass
 
     def unregister(self,dev):
-        #Just delete the pending id
-        try:
-            del(self.pending_devices[dev.devid])
-        except:
-            pass
+        #Just delete the pending device
+        self.registry.remove(dev.devid, dev)
 
     def new_key(self, devid, key):
+        if self.known_devices.get(devid) != key and self.fingerprints.pop(devid, None):
+            self.persist_fingerprints()
         self.known_devices[devid] = key
-        if devid in self.ignore_devices:
-            self.ignore_devices.remove(devid)
+        self.registry.ignored.discard(devid)
         self.persist_keys()
 
+    @staticmethod
+    def key_digest(key):
+        """A digest of the key, so fingerprints can be checked against the current key"""
+        return md5(key.encode() if isinstance(key, str) else key).hexdigest()[:16]
+
+    def fingerprint(self, devid, fingerprint=MISSING):
+        """The fingerprint of devid, None if there is none, or it was learnt with another key"""
+        if fingerprint is MISSING:
+            fingerprint = self.fingerprints.get(devid)
+        if fingerprint and devid in self.known_devices and \
+                fingerprint.get("key") == self.key_digest(self.known_devices[devid]) and \
+                fingerprint.get("class") in self.device_classes:
+            return fingerprint
+        return None
+
+    def learn(self, dev):
+        """Record the fingerprint of a device"""
+        fingerprint = {"class": dev.__class__.__name__, "version": dev.cipher.version.decode(),
+                       "ip": dev.ip, "key": self.key_digest(self.known_devices[dev.devid])}
+        if self.fingerprints.get(dev.devid) != fingerprint:
+            self.fingerprints[dev.devid] = fingerprint
+            self.persist_fingerprints()
+
+    def snapshot(self):
+        """The fingerprints, with the last status of the running devices, to be saved for warm_start
+
+        :returns: the fingerprints, with a "status" entry for the devices that reported one
+        :rtype: dict
+        """
+        snapshot = {}
+        for devid, fingerprint in self.fingerprints.items():
+            entry = snapshot[devid] = dict(fingerprint)
+            dev = self.running_devices.get(devid)
+            if dev is not None and len(dev.last_status):
+                entry["status"] = dev.last_status.as_dict()
+        return snapshot
+
+    def warm_start(self, snapshot=None):
+        """Start the devices of snapshot right away, from their last known IP address, instead of
+        waiting for their broadcasts. The saved status, if any, is loaded in the device last_status,
+        last_seen stays 0 until the device reports. Broadcasts received later only confirm, or correct,
+        the IP addresses.
+
+        :param snapshot: As returned by snapshot. By default the fingerprints
+        :type snapshot: dict
+        :returns: the devices started
+        :rtype: list
+        """
+        if snapshot is None:
+            snapshot = self.fingerprints
+        started = []
+        for devid, entry in snapshot.items():
+            if devid in self.registry or devid in self.registry.ignored:
+                continue
+            if not self.fingerprint(devid, entry) or not entry.get("ip"):
+                continue
+            dev = self.device_classes[entry["class"]](devid, self.known_devices[devid], entry["ip"], parent=self.dev_parent, vers=entry["version"])
+            if entry.get("status"):
+                dev.last_status.update(entry["status"])
+            self.registry.add(dev)
+            self.learn(dev)
+            self.start_device(dev)
+            started.append(dev)
+        return started
 
     def persist_keys(self):
         pass
@@ -897,6 +2624,14 @@ class TuyaManager:
     def load_keys(self):
         pass
 
+    def persist_fingerprints(self):
+        """Save self.fingerprints, called when it changes"""
+        pass
+
+    def load_fingerprints(self):
+        """Load the saved fingerprints in self.fingerprints, called in __init__"""
+        pass
+
 
     def got_data(self,data):
         """We are trying to figure out the device type"""
@@ -912,40 +2647,44 @@ class TuyaManager:
         if len(data) == 2 and '1' in data and data['1'] in ['1', '2', '3']:
             tclass = TuyaOCSwitch
         elif len(data) == 2 and '1' in data and data['1'] in [True, False]:
-            tclass = TuyaSwitchscanner
+            tclass = TuyaSwitch
         elif len(data) == 11 and '2' in data and data['2'] in ["white", "colour", "scene"]:
             tclass = TuyaLight
         else:
-            self.ignore_devices.append(data["devId"])
+            self.registry.ignored.add(data["devId"])
 
         if tclass:
-            newdev = tclass(discdev.devid, self.known_devices[discdev.devid],discdev.ip, parent = self.dev_parent, vers=self.version_devices[data["devId"]])
-            self.running_devices[newdev.devid] = newdev
-            newdev.start(self.loop)
+            newdev = tclass(discdev.devid, self.known_devices[discdev.devid],discdev.ip, parent = self.dev_parent, vers=self.registry.version(data["devId"]))
+            self.registry.add(newdev)
+            self.learn(newdev)
+            self.start_device(newdev)
         else:
             log.debug("No match for {}".format(data))
-        self.pending_devices[data["devId"]].seppuku()
-        del(self.pending_devices[data["devId"]])
+        self.registry.remove(data["devId"], discdev)
+        discdev.seppuku()
 
     def got_error(self, dev, data):
         """Looks like we got a problem. Given how we do things, this must be from one of the pending
         devices, i.e. some generic device. Let's try to send a command to see if that fix things."""
         log.debug("Got error from {}: {}".format(dev.devid,data))
-        if dev.devid not in self.error_device:
-            self.error_device[dev.devid] = 0
+        count = self.registry.error(dev)
+        if count == 0:
+            #Not one of ours
+            return
+        if count == 1:
             #Only the first time around
             dev.raw_set({'1':False})
-        elif self.error_device[dev.devid] == 1:
+        elif count == 2:
             #Try the second time around
             dev.raw_set({'1':'3'})
 
-        self.error_device[dev.devid] += 1
-        if self.error_device[dev.devid]>=5:
+        if count>=5:
             try:
                 log.debug("Done trying with {}".format(dev.devid))
-                self.ignore_devices.append(dev.devid)
-                self.pending_devices[dev.devid].seppuku()
-                del(self.error_device[dev.devid])
+                self.registry.ignored.add(dev.devid)
+                #Also drops its error count
+                self.registry.remove(dev.devid, dev)
+                dev.seppuku()
             except Exception as e:
                 log.debug("Error disabling dev {}, {}".format(dev.devid, e))
 
@@ -956,9 +2695,8 @@ class TuyaManager:
         log.debug("           running : {}".format(self.running_devices))
         log.debug("           pending : {}".format(self.pending_devices))
         log.debug("          ignoring : {}".format(self.ignore_devices))
-        for x in self.pending_devices.values():
-            x.seppuku()
-        for x in self.running_devices.values():
+        self.admission.clear()
+        for x in list(self.registry):
             x.seppuku()
 
 
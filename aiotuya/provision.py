@@ -45,13 +45,13 @@
 import asyncio as aio
 import socket
 import hmac
-import json
 import math
 from hashlib import md5, sha256
 from time import time
 from collections import OrderedDict
 import aiohttp, random,string
 import logging
+from .aiotuya import json_dumps, json_loads
 
 PORT = 6668
 RPORT = 63145
@@ -114,7 +114,7 @@ class TuyaCloud(object):
     async def _request(self, command, data, version="1.0"):
 
         def shufflehash(data):
-            prehash = md5(data.encode()).hexdigest()
+            prehash = md5(data).hexdigest()
             return prehash[8:16] + prehash[0:8] + prehash[24:32] + prehash[16:24]
 
         def sortOD(od):
@@ -126,6 +126,7 @@ class TuyaCloud(object):
                     res[k] = v
             return res
 
+        postdata = json_dumps(data)
         rawdata = {"a": command,
                  "deviceId": data.get("deviceId",self.deviceid),
                  "os": 'Linux',
@@ -133,7 +134,7 @@ class TuyaCloud(object):
                  "v": version,
                  "clientId": self.key,
                  "time": round(time()),
-                 "postData": json.dumps(data,separators=(',', ':'))}
+                 "postData": postdata.decode()}
 
         if self.sessionid:
             rawdata["sid"] = self.sessionid
@@ -151,7 +152,7 @@ class TuyaCloud(object):
                 tosign += "||"
             tosign += key + "="
             if key == 'postData':
-                tosign += shufflehash(rawdata[key])
+                tosign += shufflehash(postdata)
             else:
                 tosign += str(rawdata[key])
 
@@ -163,8 +164,7 @@ class TuyaCloud(object):
 
         async with aiohttp.ClientSession() as session:
             async with session.get(REGIONURL[self.region], params=rawdata) as resp:
-                rdata = await resp.text()
-                rdata = json.loads(rdata)
+                rdata = json_loads(await resp.read())
 
         if not rdata["success"]:
             myex = Exception("Error in request: Code: {}, Message: {}".format(rdata["errorCode"], rdata["errorMsg"]))
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# Memory used per device, measured with tracemalloc.
+#
+#     python3 benchmarks/memory.py [count ...]
+#
+# Memory allocated outside of the Python allocator, e.g. by the AES library, is not counted.
+import sys
+import tracemalloc
+from aiotuya.aiotuya import TuyaLight
+
+STATUS = {"power": "On", "mode": "white", "brightness": 100, "temperature": 5000, "colour": [0, 100, 100]}
+
+
+def bytes_per_device(count):
+    devs = []
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for idx in range(count):
+        dev = TuyaLight("%020d" % idx, "%016x" % idx, "10.%d.%d.%d" % (idx >> 16, (idx >> 8) & 255, idx & 255))
+        dev.last_status["devId"] = dev.devid
+        dev.last_status.update(STATUS)
+        devs.append(dev)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / count
+
+
+if __name__ == '__main__':
+    for count in [int(x) for x in sys.argv[1:]] or [1000, 10000]:
+        print("{:>8} devices: {:>8.0f} bytes/device".format(count, bytes_per_device(count)))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# Time to sweep a network, depending on the sweep concurrency.
+#
+#     python3 benchmarks/sweep.py [concurrency ...]
+#
+# The network is simulated on the loopback: 127.0.1.0/24 with DEVICES devices answering
+# after LATENCY secs, SILENT hosts accepting connections but never answering, the other
+# hosts refusing the connection. On a real LAN, absent hosts usually cost the full timeout.
+import asyncio as aio
+import json
+import sys
+import time
+from aiotuya.aiotuya import TuyaMessage, TuyaSweep
+
+NETWORK = "127.0.1.0/24"
+PORT = 16668
+DEVICES = 40
+SILENT = 40
+LATENCY = 0.05
+TIMEOUT = 0.2
+
+
+class FakeDevice(aio.Protocol):
+
+    def __init__(self, devid):
+        self.devid = devid
+        self.message = TuyaMessage()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        if self.devid and self.message.feed(data):
+            status = {"devId": self.devid, "dps": {"1": True}}
+            frame = self.message.encode("get", (json.dumps(status).encode(),))
+            aio.get_event_loop().call_later(LATENCY, self.transport.write, bytes(frame))
+
+
+class Counter:
+
+    def __init__(self):
+        self.found = 0
+
+    def notify(self, data):
+        self.found += 1
+
+
+async def main(concurrencies):
+    loop = aio.get_event_loop()
+    servers = []
+    for idx in range(DEVICES + SILENT):
+        devid = "%020d" % idx if idx < DEVICES else None
+        servers.append(await loop.create_server(lambda devid=devid: FakeDevice(devid), "127.0.1.%d" % (idx + 1), PORT))
+    for concurrency in concurrencies:
+        counter = Counter()
+        start = time.perf_counter()
+        await TuyaSweep(counter, NETWORK, port=PORT, concurrency=concurrency, timeout=TIMEOUT).run()
+        print("concurrency {:>4}: {:>6.2f} secs, {} devices found".format(concurrency, time.perf_counter() - start, counter.found))
+    for server in servers:
+        server.close()
+
+
+if __name__ == '__main__':
+    aio.run(main([int(x) for x in sys.argv[1:]] or [1, 4, 16, 64, 256]))
@@ -0,0 +1,350 @@
+# -*- coding:utf-8 -*-
+import asyncio as aio
+import json
+import unittest
+from aiotuya.aiotuya import RECONBASE, RECONMAX, STATUSCMD, TuyaCipher, TuyaDecryptError, TuyaMessage, TuyaLight, TuyaSweep, TuyaTransitions
+
+KEY = "0123456789abcdef"
+
+
+class Transport:
+
+    def __init__(self):
+        self.frames = []
+
+    def write(self, data):
+        self.frames.append(bytes(data))
+
+    def close(self):
+        self.closed = True
+
+
+def ack(seqno):
+    return bytes(TuyaMessage().encode("set", (b"",), seqno))
+
+
+def status(devid, dps, seqno=0):
+    """A query reply"""
+    return bytes(TuyaMessage().encode("get", (json.dumps({"devId": devid, "dps": dps}).encode(),), seqno))
+
+
+def push(dev, dps, seqno=0):
+    """A status pushed by the device"""
+    frame = TuyaMessage().encode("set", dev.cipher.payload("set", {"devId": dev.devid, "dps": dps}), seqno)
+    frame[11] = STATUSCMD
+    return bytes(TuyaMessage().renumber(frame, seqno))
+
+
+def light(loop):
+    dev = TuyaLight("dev", KEY, "127.0.0.1", vers="3.1")
+    dev.loop = loop
+    dev.transport = Transport()
+    return dev
+
+
+class TestWaiters(unittest.TestCase):
+
+    def test_aset_in_one_coalesce_window(self):
+        async def run():
+            loop = aio.get_event_loop()
+            dev = light(loop)
+            dev.coalesce = 0
+            first = loop.create_task(dev.aset({"power": True}, timeout=1))
+            second = loop.create_task(dev.aset({"power": False}, timeout=1))
+            await aio.sleep(0.01)
+            self.assertEqual(len(dev.transport.frames), 1)
+            seqno = int.from_bytes(dev.transport.frames[0][4:8], "big")
+            dev.data_received(ack(seqno))
+            dev.data_received(push(dev, {"1": False}))
+            results = await aio.gather(first, second)
+            self.assertEqual([x["power"] for x in results], ["Off", "Off"])
+            self.assertFalse(dev.waiting)
+            self.assertFalse(dev.acked)
+        aio.run(run())
+
+    def test_heartbeat_reply_does_not_resolve_aset(self):
+        async def run():
+            loop = aio.get_event_loop()
+            dev = light(loop)
+            task = loop.create_task(dev.aset({"brightness": 200}, timeout=1))
+            await aio.sleep(0)
+            seqno = int.from_bytes(dev.transport.frames[0][4:8], "big")
+            dev.data_received(status("dev", {"1": True, "3": 50}))
+            await aio.sleep(0)
+            self.assertFalse(task.done())
+            #Stale values pushed with another sequence number do not confirm it either
+            dev.data_received(push(dev, {"1": True, "3": 50}, seqno + 1))
+            await aio.sleep(0)
+            self.assertFalse(task.done())
+            dev.data_received(push(dev, {"1": True, "3": 200}, seqno + 1))
+            self.assertEqual((await task)["brightness"], 200)
+            self.assertFalse(dev.waiting)
+        aio.run(run())
+
+    def test_query_reply_after_ack_does_not_resolve_aset(self):
+        async def run():
+            loop = aio.get_event_loop()
+            dev = light(loop)
+            task = loop.create_task(dev.aset({"brightness": 200}, timeout=1))
+            await aio.sleep(0)
+            seqno = int.from_bytes(dev.transport.frames[0][4:8], "big")
+            dev.data_received(ack(seqno))
+            dev.data_received(status("dev", {"1": True, "3": 50}))
+            await aio.sleep(0)
+            self.assertFalse(task.done())
+            dev.data_received(push(dev, {"3": 200}))
+            self.assertEqual((await task)["brightness"], 200)
+        aio.run(run())
+
+
+class TestFraming(unittest.TestCase):
+
+    def corrupt(self):
+        badsize = bytearray(ack(1))
+        badsize[12:16] = (1 << 20).to_bytes(4, "big")
+        badsuffix = bytearray(ack(2))
+        badsuffix[-1] ^= 0xff
+        return bytes(badsize + badsuffix) + ack(3)
+
+    def check(self, result):
+        errors = [str(x[1]) for x in result if x[0] == 999]
+        self.assertEqual(errors, ["Incorrect message size", "Incorrect suffix"])
+        self.assertEqual([x[2] for x in result if x[0] != 999], [3])
+
+    def test_bad_frame_reported_once(self):
+        self.check(TuyaMessage().parse(self.corrupt()))
+        msg = TuyaMessage()
+        self.check(msg.feed(self.corrupt()))
+        self.assertEqual(len(msg.buffer), 0)
+
+    def test_frames_split_across_reads(self):
+        data = ack(1) + status("dev", {"1": True}, 2) + ack(3)
+        for size in (1, 5, 17, len(ack(1)) + 3, len(data)):
+            msg = TuyaMessage()
+            result = []
+            for x in range(0, len(data), size):
+                result += msg.feed(data[x:x+size])
+            self.assertEqual([x[2] for x in result], [1, 2, 3])
+            self.assertEqual([x[0] for x in result], [0, 0, 0])
+            self.assertEqual(result[1][1], {"devId": "dev", "dps": {"1": True}})
+            self.assertEqual(len(msg.buffer), 0)
+
+
+
+class TestCipher(unittest.TestCase):
+
+    payload = {"devId": "dev", "dps": {"1": True, "3": 200}}
+
+    def test_v33_round_trip_with_version_header(self):
+        cipher = TuyaCipher(KEY, "3.3")
+        frame = TuyaMessage().encode("set", cipher.payload("set", self.payload), 7)
+        self.assertEqual(frame[16:19], b"3.3")
+        self.assertEqual(TuyaMessage(cipher=cipher).feed(frame), [(0, self.payload, 7)])
+
+    def test_v33_round_trip_without_version_header(self):
+        cipher = TuyaCipher(KEY, "3.3")
+        data, = cipher.payload("get", self.payload)
+        self.assertEqual(cipher.decrypt(data), self.payload)
+        frame = TuyaMessage().encode("get", (b"\x00" * 4, data), 8)
+        self.assertEqual(TuyaMessage(cipher=cipher).feed(frame), [(0, self.payload, 8)])
+
+    def test_v33_wrong_key(self):
+        data, = TuyaCipher(KEY, "3.3").payload("get", self.payload)
+        with self.assertRaises(TuyaDecryptError):
+            TuyaCipher("fedcba9876543210", "3.3").decrypt(data)
+
+
+
+class Parent:
+
+    def __init__(self):
+        self.attempts = []
+
+    def register(self, dev):
+        pass
+
+    def unregister(self, dev):
+        pass
+
+    def reconnecting(self, dev, attempt, delay):
+        self.attempts.append((attempt, delay))
+
+
+class Admission:
+
+    def __init__(self):
+        self.admitted = []
+
+    def admit(self, dev):
+        self.admitted.append(dev)
+
+    def cancel(self, dev):
+        pass
+
+
+class Scheduler:
+
+    def add(self, dev):
+        pass
+
+    def remove(self, dev):
+        pass
+
+
+class TestReconnect(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = aio.new_event_loop()
+        self.parent = Parent()
+        self.dev = TuyaLight("dev", KEY, "127.0.0.1", parent=self.parent)
+        self.dev.loop = self.loop
+        self.dev.admission = Admission()
+        self.dev.scheduler = Scheduler()
+        self.dev.reconnect = True
+
+    def tearDown(self):
+        self.loop.close()
+
+    def lose_connection(self):
+        self.dev.transport = Transport()
+        self.dev.connection_lost(None)
+
+    def test_backoff(self):
+        for x in range(10):
+            self.lose_connection()
+            self.dev.reconnect_handle.cancel()
+            self.dev.reconnect_handle = None
+        self.assertEqual([x[0] for x in self.parent.attempts], list(range(1, 11)))
+        for attempt, delay in self.parent.attempts:
+            ceiling = min(RECONMAX, RECONBASE * 2 ** (attempt - 1))
+            self.assertTrue(ceiling / 2 <= delay <= ceiling)
+        self.dev.connection_made(Transport())
+        self.assertEqual(self.dev.reconnect_attempt, 0)
+
+    def test_redial_while_waiting(self):
+        self.lose_connection()
+        self.lose_connection()
+        handle = self.dev.reconnect_handle
+        self.dev.redial()
+        self.assertTrue(handle.cancelled())
+        self.assertIsNone(self.dev.reconnect_handle)
+        self.assertEqual(self.dev.reconnect_attempt, 0)
+        self.assertEqual(self.dev.admission.admitted, [self.dev])
+
+    def test_redial_while_connected(self):
+        transport = self.dev.transport = Transport()
+        self.dev.redial()
+        self.assertTrue(transport.closed)
+        self.assertIsNone(self.dev.transport)
+        self.assertEqual(self.dev.admission.admitted, [])
+
+    def test_no_reconnect_after_seppuku(self):
+        self.lose_connection()
+        handle = self.dev.reconnect_handle
+        self.dev.seppuku()
+        self.assertTrue(handle.cancelled())
+        self.lose_connection()
+        self.assertIsNone(self.dev.reconnect_handle)
+
+
+
+class TestSweep(unittest.TestCase):
+
+    def test_identify_payload_starting_with_zero(self):
+        reply = json.dumps({"devId": "dev33", "dps": {"1": True}}).encode()
+        for idx in range(10000):
+            key = chr(32 + idx % 95) + "%015d" % idx
+            cipher = TuyaCipher(key, "3.3")
+            data = cipher.cipher.encrypt(cipher.pad(reply))
+            if not data[0]:
+                break
+        frame = bytes(TuyaMessage().encode("get", (b"\x00" * 4, data)))
+        sweep = TuyaSweep(None, "127.0.0.1/32")
+        sweep.candidates = [("other", KEY), ("dev33", key)]
+        self.assertEqual(sweep.identify(frame), {"gwId": "dev33", "version": "3.3"})
+        self.assertIsNone(sweep.identify(frame[:-1]))
+
+
+
+class TestDecoding(unittest.TestCase):
+
+    def test_bad_dp_value_is_dropped(self):
+        async def run():
+            dev = light(aio.get_event_loop())
+            dev.data_received(status("dev", {"1": True, "4": None, "5": "ff0"}))
+            self.assertEqual(dev.last_status["power"], "On")
+            self.assertNotIn("temperature", dev.last_status)
+            self.assertNotIn("colour", dev.last_status)
+            dev.data_received(status("dev", []))
+            dev.data_received(bytes(TuyaMessage().encode("get", (b'[1, 2]',))))
+        aio.run(run())
+
+
+
+class TestStatus(unittest.TestCase):
+
+    def test_status_is_a_mapping(self):
+        dev = TuyaLight("dev", KEY, "127.0.0.1")
+        dev.last_status.update({"devId": "dev", "power": "On", "other": 1})
+        self.assertEqual(dev.last_status, {"devId": "dev", "power": "On", "other": 1})
+        self.assertEqual(json.loads(json.dumps(dev.last_status.as_dict()))["power"], "On")
+        del dev.last_status["power"]
+        self.assertNotIn("power", dev.last_status)
+        self.assertEqual(len(dev.last_status), 2)
+
+    def test_optimistic_containers_created_when_needed(self):
+        async def run():
+            dev = light(aio.get_event_loop())
+            self.assertIsNone(dev.pending)
+            self.assertIsNone(dev.pending_handles)
+            dev.set({"brightness": 100})
+            self.assertIsNone(dev.pending)
+            dev.optimistic = 1
+            dev.set({"brightness": 200})
+            self.assertEqual(dev.last_status["brightness"], 200)
+            self.assertIn("brightness", dev.pending)
+            dev.data_received(push(dev, {"3": 200}))
+            self.assertFalse(dev.pending)
+            self.assertFalse(dev.pending_handles)
+        aio.run(run())
+
+
+
+class TestTransitions(unittest.TestCase):
+
+    def test_engine_dropped_when_idle(self):
+        async def run():
+            dev = light(aio.get_event_loop())
+            trans = dev.fadein_white(100, 4000, 0.1)
+            self.assertEqual(len(TuyaTransitions.engines), 1)
+            while trans.active:
+                await aio.sleep(0.05)
+            self.assertEqual(TuyaTransitions.engines, {})
+            self.assertTrue(dev.transport.frames)
+            dev.fadein_white(100, 4000, 10).cancel()
+            self.assertEqual(TuyaTransitions.engines, {})
+        aio.run(run())
+
+    def test_engine_of_closed_loop_dropped(self):
+        async def run():
+            light(aio.get_event_loop()).fadein_white(100, 4000, 10)
+        for x in range(3):
+            aio.run(run())
+        self.assertEqual(len(TuyaTransitions.engines), 1)
+        TuyaTransitions.get(aio.new_event_loop()).loop.close()
+        TuyaTransitions.get(aio.new_event_loop()).loop.close()
+        self.assertEqual(len(TuyaTransitions.engines), 1)
+        TuyaTransitions.engines.clear()
+
+
+
+class TestColour(unittest.TestCase):
+
+    def test_mixed_case_colour(self):
+        self.assertEqual(TuyaLight.tuya_to_hsv("ff000000aBcdEf"), TuyaLight.tuya_to_hsv("ff000000abcdef"))
+        self.assertEqual(TuyaLight.tuya_to_rgb("fF00Aa0000ffff"), [255, 0, 170])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
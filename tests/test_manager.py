@@ -0,0 +1,99 @@
+# -*- coding:utf-8 -*-
+import asyncio as aio
+import unittest
+from aiotuya.aiotuya import TuyaDevice, TuyaLight, TuyaManager, TuyaRegistry, TuyaSwitch
+
+KEY = "0123456789abcdef"
+
+
+class Transport:
+
+    def __init__(self):
+        self.frames = []
+
+    def write(self, data):
+        self.frames.append(bytes(data))
+
+    def close(self):
+        pass
+
+
+class TestRegistry(unittest.TestCase):
+
+    def populate(self):
+        registry = TuyaRegistry()
+        self.light1 = TuyaLight("light1", KEY, "192.168.1.10")
+        self.light2 = TuyaLight("light2", KEY, "192.168.2.10")
+        self.switch = TuyaSwitch("switch", KEY, "192.168.1.11")
+        self.probe = TuyaDevice("probe", KEY, "192.168.1.12")
+        for dev in (self.light1, self.light2, self.switch):
+            registry.add(dev)
+        registry.add(self.probe, "pending")
+        return registry
+
+    def test_find(self):
+        registry = self.populate()
+        self.assertEqual(set(registry.find(cls=TuyaLight)), {self.light1, self.light2})
+        self.assertEqual(set(registry.find(cls=TuyaDevice, state="running")), {self.light1, self.light2, self.switch})
+        self.assertEqual(set(registry.find(network="192.168.1.0/24")), {self.light1, self.switch, self.probe})
+        self.assertEqual(registry.find(cls=TuyaLight, network="192.168.1.0/24"), [self.light1])
+        self.assertEqual(registry.find(state="pending", network="192.168.1.0/24"), [self.probe])
+        self.assertEqual(registry.find(ip="192.168.1.11"), [self.switch])
+        self.assertEqual(registry.find(ip="192.168.1.99"), [])
+
+    def test_set_ip(self):
+        registry = self.populate()
+        registry.set_ip(self.light1, "192.168.2.20")
+        self.assertEqual(self.light1.ip, "192.168.2.20")
+        self.assertNotIn("192.168.1.10", registry.by_ip)
+        self.assertNotIn("192.168.1.10", registry.addresses)
+        self.assertEqual(registry.find(ip="192.168.2.20"), [self.light1])
+        self.assertEqual(set(registry.find(cls=TuyaLight, network="192.168.2.0/24")), {self.light1, self.light2})
+        #Devices sharing an address
+        registry.set_ip(self.light2, "192.168.2.20")
+        self.assertEqual(set(registry.find(ip="192.168.2.20")), {self.light1, self.light2})
+        registry.remove("light1")
+        self.assertEqual(registry.find(ip="192.168.2.20"), [self.light2])
+        self.assertEqual(registry.by_ip["192.168.2.20"], {"light2"})
+        #A device that is not, or no longer, registered only gets its address changed
+        registry.set_ip(self.light1, "192.168.1.30")
+        self.assertNotIn("192.168.1.30", registry.by_ip)
+
+
+class TestManager(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = aio.new_event_loop()
+        self.manager = TuyaManager({"dev": KEY}, loop=self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def device(self, devid="dev", ip="10.0.0.1", vers="3.3"):
+        dev = TuyaDevice(devid, KEY, ip, parent=[self.manager], vers=vers)
+        dev.loop = self.loop
+        dev.transport = Transport()
+        return dev
+
+    def test_version_and_errors_dropped_with_the_device(self):
+        registry = self.manager.registry
+        dev = self.device()
+        registry.add(dev, "pending")
+        self.assertEqual(self.manager.version_devices, {"dev": "3.3"})
+        for x in range(4):
+            self.manager.got_error(dev, "error")
+        self.assertEqual(registry.errors, {"dev": 4})
+        self.assertEqual(len(dev.transport.frames), 2)
+        self.manager.got_error(dev, "error")
+        self.assertIn("dev", self.manager.ignore_devices)
+        self.assertNotIn("dev", registry)
+        self.assertEqual(registry.versions, {})
+        self.assertEqual(registry.errors, {})
+        #Errors from a device that is not registered are not counted
+        self.manager.got_error(dev, "error")
+        self.assertEqual(registry.errors, {})
+
+
+
+if __name__ == '__main__':
+    unittest.main()